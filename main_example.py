@@ -1,5 +1,25 @@
+import json
+import hashlib
+import shutil
+import tempfile
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
+try:
+    from casatools import table as tbtool
+except:
+    pass # NOTE: CASA < 6 provides tbtool as a builtin.
+
+try:
+    from multiprocessing import shared_memory, \
+                                resource_tracker
+    shared_memory_is_imported = True
+except:
+    shared_memory_is_imported = False
+
 try:
     from astropy import units, \
                         constants
@@ -9,13 +29,11 @@ except:
     astropy_is_imported = False
 
 
-def getcol_wrapper(ms, table, colname):
+def get_mms_partitions(ms):
     if os.path.isdir(ms):
-        tb.open(
-            "{}/{}".format(ms, table)
-        )
-        col = np.squeeze(
-            tb.getcol(colname)
+        tb.open(ms)
+        partitions = list(
+            tb.getpartnames()
         )
         tb.close()
     else:
@@ -23,6 +41,72 @@ def getcol_wrapper(ms, table, colname):
             "{} does not exist".format(ms)
         )
 
+    # NOTE: The main table of a multi-MS concatenates its sub-MSs, and
+    # getpartnames returns them in the order of concatenation (i.e. row order).
+    return partitions if len(partitions) > 1 else []
+
+def getcol_partition(ms, table, colname):
+    tb_partition = tbtool()
+    tb_partition.open(
+        "{}/{}".format(ms, table)
+    )
+    col = tb_partition.getcol(colname)
+    tb_partition.close()
+
+    return col
+
+executors = {}
+
+def get_executor(num_workers=None):
+    # NOTE: A pool is forked once and reused by every read of the sub-MSs (e.g.
+    # of both ANTENNA1 and ANTENNA2 in get_antennas). num_workers=None reuses
+    # the pool already open (sized in __main__), else opens one with a worker
+    # per CPU this process may run on (as plan_export assumes); "fork" so that
+    # the workers see the functions of this script, which is exec'd rather
+    # than imported.
+    if num_workers is None:
+        if executors:
+            return next(iter(executors.values()))
+        num_workers = len(os.sched_getaffinity(0))
+    if num_workers not in executors:
+        executors[num_workers] = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("fork")
+        )
+        atexit.register(executors[num_workers].shutdown)
+
+    return executors[num_workers]
+
+def getcol_wrapper(ms, table, colname, num_workers=None):
+    if os.path.isdir(ms):
+        partitions = get_mms_partitions(ms=ms) if table == "" else []
+        if partitions:
+            # NOTE: Each sub-MS is read by its own process and table tool (the
+            # table tool holds the GIL).
+            cols = list(
+                get_executor(num_workers=num_workers).map(
+                    getcol_partition,
+                    partitions,
+                    [table] * len(partitions),
+                    [colname] * len(partitions)
+                )
+            )
+            col = np.squeeze(
+                np.concatenate(cols, axis=-1)
+            )
+        else:
+            tb.open(
+                "{}/{}".format(ms, table)
+            )
+            col = np.squeeze(
+                tb.getcol(colname)
+            )
+            tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+
     return col
 
 def get_num_chan(ms):
@@ -57,11 +141,18 @@ def get_visibilities(ms):
 
     return visibilities
 
-def export_visibilities(ms, filename):
+def export_visibilities(ms, filename, phase_center=None, nrow_chunk=100000):
     if os.path.isfile(filename):
         print(
             "{} already exists".format(filename)
         )
+    elif phase_center is not None:
+        export_phase_shifted(
+            ms=ms,
+            filename=filename,
+            phase_center=phase_center,
+            nrow_chunk=nrow_chunk
+        )
     else:
         visibilities = get_visibilities(ms=ms)
         print(
@@ -146,75 +237,118 @@ def export_uv_wavelengths(ms, filename):
                 np.save(file, uv_wavelengths)
 
 
-# def get_sigma(ms):
-#
-#     if os.path.isdir(ms):
-#         sigma = getcol_wrapper(
-#             ms=ms,
-#             table="",
-#             colname="SIGMA"
-#         )
-#     else:
-#         raise IOError(
-#             "{} does not exisxt".format(ms)
-#         )
-#
-#     return sigma
-#
-#
-# def export_sigma(ms, width, spw, contsub):
-#
-#     filename = "width_{}/sigma_spw_{}{}.fits".format(
-#         width,
-#         spw,
-#         ".contsub" if contsub else ''
-#     )
-#     if os.path.isfile(filename):
-#         print(
-#             "{} already exists".format(filename)
-#         )
-#     else:
-#         sigma = get_sigma(
-#             ms="width_{}/{}".format(
-#                 width,
-#                 ms if ms.endswith(".statwt") else "{}.statwt".format(ms)
-#             )
-#         )
-#
-#         # sigma = np.average(
-#         #     a=sigma,
-#         #     axis=0
-#         # )
-#
-#         num_chan = getcol_wrapper(
-#             ms=ms,
-#             table="SPECTRAL_WINDOW",
-#             colname="NUM_CHAN"
-#         )
-#
-#         if num_chan == width:
-#             pass
-#         else:
-#             sigma = np.tile(
-#                 A=sigma,
-#                 reps=(
-#                     int(num_chan / width), 1
-#                 )
-#             )
-#
-#         sigma = np.stack(
-#             arrays=(sigma, sigma),
-#             axis=-1
-#         )
-#
-#         print(
-#             "shape (sigma):", sigma.shape
-#         )
-#         fits.writeto(
-#             filename=filename,
-#             data=sigma,
-#             overwrite=True
-#         )
+def get_sigma(ms, timebin=60.0, exclude_channels=None, nrow_chunk=100000):
+    # NOTE: As CASA's statwt, the scatter of the visibilities is computed per
+    # correlation within each (scan, baseline, time bin), over its unflagged rows
+    # and channels. exclude_channels are inclusive (start, stop) ranges, e.g. the
+    # channels of an emission line, that do not enter the scatter.
+    antenna1, antenna2 = get_antennas(ms=ms)
+    time = get_time(ms=ms)
+    scans = get_scans(ms=ms)
+    _, groups = np.unique(
+        np.stack(
+            arrays=(
+                scans,
+                antenna1,
+                antenna2,
+                np.floor((time - np.min(time)) / timebin).astype(np.int64),
+            )
+        ),
+        axis=1,
+        return_inverse=True
+    )
+    groups = groups.ravel()
+    num_groups = int(np.max(groups)) + 1
+    num_chan = np.atleast_1d(
+        get_num_chan(ms=ms)
+    )[0]
+    channels = np.ones(num_chan, dtype=bool)
+    if exclude_channels is not None:
+        for start, stop in exclude_channels:
+            channels[start:stop + 1] = False
+
+    sums = None
+    for startrow, cols in iter_col_chunks(
+        ms=ms,
+        table="",
+        colnames=["DATA", "FLAG"],
+        nrow_chunk=nrow_chunk
+    ):
+        data = cols["DATA"]
+        num_corr = data.shape[0]
+        if sums is None:
+            sums = np.zeros(
+                shape=(5, num_corr * num_groups)
+            )
+        valid = ~cols["FLAG"] & channels[np.newaxis, :, np.newaxis]
+
+        # NOTE: In float64 (DATA is often complex64), as the variance is taken
+        # from the difference of sums of squares.
+        real = np.where(valid, data.real.astype(np.float64), 0.0)
+        imag = np.where(valid, data.imag.astype(np.float64), 0.0)
+        index = (
+            np.arange(num_corr)[:, np.newaxis] * num_groups + groups[np.newaxis, startrow:startrow + data.shape[-1]]
+        ).ravel()
+        for i, values in enumerate([
+            valid,
+            real,
+            imag,
+            real ** 2.0,
+            imag ** 2.0,
+        ]):
+            sums[i] += np.bincount(
+                index,
+                weights=np.sum(values, axis=1).ravel(),
+                minlength=num_corr * num_groups
+            )
+    n, sum_real, sum_imag, sum_real_squared, sum_imag_squared = sums.reshape(5, -1, num_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance_real = (sum_real_squared - sum_real ** 2.0 / n) / (n - 1.0)
+        variance_imag = (sum_imag_squared - sum_imag ** 2.0 / n) / (n - 1.0)
+        sigma = np.sqrt(
+            (variance_real + variance_imag) / 2.0
+        )
+
+    # NOTE: Bins with fewer than two samples have no scatter; they get zero weight.
+    sigma[n < 2] = np.inf
+    print(
+        "{} of {} bins without an estimate of sigma".format(
+            np.count_nonzero(n < 2), n.size
+        )
+    )
+
+    return sigma[:, groups]
+
+def export_sigma(ms, filename, timebin=60.0, exclude_channels=None, nrow_chunk=100000):
+    if product_exists(filename=filename):
+        print(
+            "{} already exists".format(filename)
+        )
+    else:
+        sigma = get_sigma(
+            ms=ms,
+            timebin=timebin,
+            exclude_channels=exclude_channels,
+            nrow_chunk=nrow_chunk
+        )
+        num_chan = np.atleast_1d(
+            get_num_chan(ms=ms)
+        )[0]
+
+        # NOTE: Same shape as the visibilities, i.e. the same sigma for every
+        # channel and for the real and imaginary parts.
+        output = open_chunked_writer(
+            filename=filename,
+            shape=(sigma.shape[0], num_chan, sigma.shape[1], 2),
+            dtype=np.float64
+        )
+        for startrow in range(0, sigma.shape[1], nrow_chunk):
+            rows = slice(startrow, startrow + nrow_chunk)
+            output[:, :, rows, :] = sigma[:, np.newaxis, rows, np.newaxis]
+        close_chunked_writer(filename=filename, array=output)
+        print(
+            "shape (sigma):", output.shape
+        )
 
 def get_frequencies(uid, field, spw):
     ms = "{}_field_{}_spw_{}.ms.split.cal".format(
@@ -290,13 +424,14 @@ def export_antennas(ms, filename):
         with open(filename, 'wb') as file:
             np.save(file, antennas)
 
-# def get_time(ms):
-#     time = getcol_wrapper(
-#         ms=ms,
-#         table="",
-#         colname="TIME"
-#     )
-#     return np.asarray(time)
+def get_time(ms):
+    time = getcol_wrapper(
+        ms=ms,
+        table="",
+        colname="TIME"
+    )
+    return np.asarray(time)
+
 # def export_time(ms, filename):
 #
 #     time = get_time(
@@ -344,32 +479,1201 @@ def export_scans(ms, filename):
         with open(filename, 'wb') as file:
             np.save(file, scans)
 
-if __name__ == "__main__":
-    #uid = "A002_X11adad7_Xd8c1"
-    uid = "A002_X11adad7_Xdfdb"
-    field = "SPT0314-44"
-    if not os.path.isdir(
-        "uid___{}_{}.ms.split.cal".format(uid, field)
+def export_shared_memory(ms, name):
+    if not shared_memory_is_imported:
+        raise ImportError(
+            "multiprocessing.shared_memory requires python >= 3.8"
+        )
+    getters = {
+        "visibilities": get_visibilities,
+        "uv_wavelengths": get_uv_wavelengths,
+        "antennas": get_antennas,
+        "scans": get_scans,
+    }
+    segments = []
+    descriptor = {}
+
+    # NOTE: The segments have to outlive this call for consumers to attach, so
+    # they are unlinked by release_shared_memory or, at the latest, on exit;
+    # registered up front so that segments created before a failure are too.
+    atexit.register(
+        release_shared_memory,
+        segments=segments,
+        descriptor=name + ".json"
+    )
+    try:
+        for product, getter in getters.items():
+            array = np.ascontiguousarray(
+                getter(ms=ms)
+            )
+            segment_name = "{}_{}".format(name, product)
+            try:
+                segment = shared_memory.SharedMemory(
+                    name=segment_name,
+                    create=True,
+                    size=max(array.nbytes, 1)
+                )
+            except FileExistsError: # NOTE: Left behind by a session that did not exit cleanly.
+                stale = shared_memory.SharedMemory(name=segment_name)
+                stale.close()
+                stale.unlink()
+                segment = shared_memory.SharedMemory(
+                    name=segment_name,
+                    create=True,
+                    size=max(array.nbytes, 1)
+                )
+            np.ndarray(
+                shape=array.shape,
+                dtype=array.dtype,
+                buffer=segment.buf
+            )[...] = array
+            segments.append(segment)
+            descriptor[product] = {
+                "name": segment.name,
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+            }
+            print(
+                "shape ({}):".format(product), array.shape
+            )
+            del array
+    except:
+        release_shared_memory(segments=segments)
+        raise
+    with open(name + ".json", 'w') as file:
+        json.dump(descriptor, file, indent=4)
+
+    return segments
+
+def release_shared_memory(segments, descriptor=None):
+    for segment in segments:
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+    if descriptor is not None and os.path.isfile(descriptor):
+        os.remove(descriptor)
+
+def attach_shared_memory(descriptor):
+    if not os.path.isfile(descriptor):
+        raise IOError(
+            "{} does not exist".format(descriptor)
+        )
+    with open(descriptor, 'r') as file:
+        products = json.load(file)
+    arrays = {}
+    segments = []
+    for product, description in products.items():
+        segment = shared_memory.SharedMemory(
+            name=description["name"]
+        )
+        # NOTE: Otherwise the resource tracker of the consumer unlinks the
+        # segment when the consumer exits, which is the exporter's job.
+        resource_tracker.unregister(
+            segment._name, "shared_memory"
+        )
+        arrays[product] = np.ndarray(
+            shape=tuple(description["shape"]),
+            dtype=np.dtype(description["dtype"]),
+            buffer=segment.buf
+        )
+        segments.append(segment)
+
+    # NOTE: The arrays are only valid for as long as the segments are open;
+    # call segment.close() on each once done (never unlink from a consumer).
+    return arrays, segments
+
+def get_data_manager_info(ms, colname="DATA"):
+    if os.path.isdir(ms):
+        tb.open(ms)
+        dminfo = tb.getdminfo()
+        datatype = tb.coldatatype(colname)
+        tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+    for dm in dminfo.values():
+        if colname in dm.get("COLUMNS", []):
+            spec = dm.get("SPEC", {})
+            tile_shapes = [
+                list(hypercube["TileShape"])
+                for hypercube in spec.get("HYPERCUBES", {}).values()
+                if "TileShape" in hypercube
+            ]
+            if not tile_shapes and "DEFAULTTILESHAPE" in spec:
+                tile_shapes = [list(spec["DEFAULTTILESHAPE"])]
+
+            return datatype, dm.get("TYPE"), tile_shapes
+
+    return datatype, None, []
+
+def format_bytes(nbytes):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(nbytes) < 1024.0 or unit == "TB":
+            break
+        nbytes /= 1024.0
+
+    return "{:.1f} {}".format(nbytes, unit)
+
+def plan_export(ms, field, spws, width, nrow_chunk=100000, bandwidth=200.0e6, max_memory=None):
+    # NOTE: Only metadata are read here; FIELD_ID and DATA_DESC_ID are the only
+    # main-table columns touched, at 4 bytes per row each.
+    field_names = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="FIELD", colname="NAME")
+    )
+    if field not in field_names:
+        raise ValueError(
+            "{} is not a field of {}".format(field, ms)
+        )
+    field_id = list(field_names).index(field)
+    spw_ids = np.atleast_1d(get_spw_ids(ms=ms))
+    polarization_ids = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="DATA_DESCRIPTION", colname="POLARIZATION_ID")
+    )
+    num_chan = np.atleast_1d(get_num_chan(ms=ms))
+    num_corr = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="POLARIZATION", colname="NUM_CORR")
+    )
+    field_ids = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="", colname="FIELD_ID")
+    )
+    data_desc_ids = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="", colname="DATA_DESC_ID")
+    )
+    datatype, dm_type, tile_shapes = get_data_manager_info(ms=ms)
+    num_partitions = max(len(get_mms_partitions(ms=ms)), 1)
+    itemsize = {"complex": 8, "dcomplex": 16}.get(datatype, 8)
+
+    plan = []
+    for spw in spws:
+        data_desc_id = list(spw_ids).index(int(spw))
+        nrow = int(
+            np.count_nonzero(
+                (field_ids == field_id) & (data_desc_ids == data_desc_id)
+            )
+        )
+        ncorr = int(num_corr[polarization_ids[data_desc_id]])
+        nchan = int(num_chan[int(spw)])
+        # NOTE: As average_channels (and split), the last bin may be partial.
+        nchan_out = -(-nchan // width)
+        nrow_stream = min(nrow, nrow_chunk)
+
+        # NOTE: Per product, (output bytes, bytes read, peak bytes per row held in
+        # memory). The in-memory path holds every row at once, so its peak is
+        # nrow times the per-row peak; a streaming pass holds nrow_chunk rows.
+        vis_row = ncorr * nchan_out * itemsize
+        uv_row = nchan_out * 2 * 8
+        products = {
+            "visibilities": (nrow * vis_row, nrow * vis_row, 2 * vis_row),
+            "uv_wavelengths": (nrow * uv_row, nrow * 3 * 8, 2 * uv_row + 3 * 8),
+            "antennas": (nrow * 2 * 4, nrow * 2 * 4, 2 * 2 * 4),
+            "scans": (nrow * 4, nrow * 4, 4),
+        }
+        stages = [
+            {
+                "stage": "split",
+                "product": "ms",
+                "output": nrow * (ncorr * nchan_out * (itemsize + 1) + 100),
+                "read": nrow * ncorr * nchan * (itemsize + 1),
+                "in_memory": None,
+                "streaming": None,
+            }
+        ]
+        for product, (output, read, peak_row) in products.items():
+            stages.append({
+                "stage": "export",
+                "product": product,
+                "output": output,
+                "read": read,
+                "in_memory": nrow * peak_row,
+                "streaming": nrow_stream * peak_row,
+            })
+        for stage in stages:
+            stage["time"] = (stage["read"] + stage["output"]) / bandwidth
+
+        entry = {
+            "spw": spw,
+            "nrow": nrow,
+            "ncorr": ncorr,
+            "nchan": nchan,
+            "nchan_out": nchan_out,
+            "stages": stages,
+        }
+        if max_memory is not None:
+            peak_row = max(peak_row for _, _, peak_row in products.values())
+            entry["nrow_chunk"] = int(
+                max(min(max_memory // peak_row, nrow), 1)
+            )
+            # NOTE: The workers read one sub-MS each (see getcol_wrapper), so there
+            # is no use for more of them than partitions or than available CPUs.
+            entry["num_workers"] = int(
+                max(
+                    min(
+                        max_memory // max(nrow_stream * peak_row, 1),
+                        len(os.sched_getaffinity(0)),
+                        num_partitions
+                    ),
+                    1
+                )
+            )
+        plan.append(entry)
+
+    print(
+        "{} (data manager: {}, tile shapes: {}, {})".format(
+            ms, dm_type, tile_shapes, datatype
+        )
+    )
+    for entry in plan:
+        print(
+            "spw {spw}: nrow = {nrow}, ncorr = {ncorr}, nchan = {nchan} -> {nchan_out}".format(**entry)
+        )
+        for stage in entry["stages"]:
+            print(
+                "    {:<7}{:<16}output {:>10}  read {:>10}  peak (in-memory) {:>10}  peak (streaming) {:>10}  ~{:.0f} s".format(
+                    stage["stage"],
+                    stage["product"],
+                    format_bytes(stage["output"]),
+                    format_bytes(stage["read"]),
+                    "-" if stage["in_memory"] is None else format_bytes(stage["in_memory"]),
+                    "-" if stage["streaming"] is None else format_bytes(stage["streaming"]),
+                    stage["time"]
+                )
+            )
+        if "nrow_chunk" in entry:
+            print(
+                "    nrow_chunk = {nrow_chunk}, num_workers = {num_workers}".format(**entry)
+            )
+    print(
+        "total: output {}, read {}".format(
+            format_bytes(sum(stage["output"] for entry in plan for stage in entry["stages"])),
+            format_bytes(sum(stage["read"] for entry in plan for stage in entry["stages"]))
+        )
+    )
+
+    return plan
+
+def iter_col_chunks(ms, table, colnames, nrow_chunk=100000):
+    if os.path.isdir(ms):
+        tb.open(
+            "{}/{}".format(ms, table)
+        )
+        try:
+            nrows = tb.nrows()
+            for startrow in range(0, nrows, nrow_chunk):
+                nrow = min(nrow_chunk, nrows - startrow)
+                yield startrow, {
+                    colname: tb.getcol(colname, startrow, nrow)
+                    for colname in colnames
+                }
+        finally:
+            tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+
+def get_fits_header(shape, dtype):
+    # NOTE: The primary header of an image of this shape and dtype; FITS lists
+    # the axes fastest first, i.e. in the reverse order of numpy.
+    header = fits.Header()
+    header["SIMPLE"] = True
+    header["BITPIX"] = {
+        "i2": 16,
+        "i4": 32,
+        "i8": 64,
+        "f4": -32,
+        "f8": -64,
+    }[np.dtype(dtype).str[1:]]
+    header["NAXIS"] = len(shape)
+    for i, n in enumerate(shape[::-1]):
+        header["NAXIS{}".format(i + 1)] = n
+    header["EXTEND"] = True
+
+    return header
+
+def open_chunked_writer(filename, shape, dtype):
+    # NOTE: Length-1 axes are left out of the file, as np.squeeze does for the
+    # in-memory exports, but kept in the returned view so that chunks can be
+    # assigned without squeezing them first. As the in-memory exports, the
+    # product is a .fits when astropy is imported: its header is written up
+    # front and the chunks straight into its (big-endian) data, so that it is
+    # never held in memory nor written twice (complex products, which FITS has
+    # no BITPIX for, stay .numpy). Until close_chunked_writer, the file is a
+    # .part, so that an interrupted export is not taken for a product.
+    shape_file = tuple(int(n) for n in shape if n != 1)
+    if astropy_is_imported and np.dtype(dtype).kind in "if":
+        header = get_fits_header(shape=shape_file, dtype=dtype).tostring().encode()
+        size = int(np.prod(shape_file)) * np.dtype(dtype).itemsize
+        with open(filename + ".fits.part", 'wb') as file:
+            file.write(header)
+            file.truncate(len(header) + -(-size // 2880) * 2880)
+        if size == 0:
+            return np.zeros(shape, dtype=dtype)
+        array = np.memmap(
+            filename + ".fits.part",
+            mode="r+",
+            dtype=np.dtype(dtype).newbyteorder(">"),
+            offset=len(header),
+            shape=shape_file
+        )
+    else:
+        array = np.lib.format.open_memmap(
+            filename + ".numpy.part",
+            mode="w+",
+            dtype=dtype,
+            shape=shape_file
+        )
+
+    return array.reshape(shape)
+
+def product_exists(filename):
+    return os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy")
+
+def close_chunked_writer(filename, array):
+    if isinstance(array, np.memmap):
+        array.flush()
+    for extension in [".fits", ".numpy"]:
+        if os.path.isfile(filename + extension + ".part"):
+            os.rename(filename + extension + ".part", filename + extension)
+
+def get_uv_range_mask(ms, uvrange):
+    uvw = getcol_wrapper(
+        ms=ms,
+        table="",
+        colname="UVW"
+    )
+    chan_freq = np.atleast_1d(
+        getcol_wrapper(
+            ms=ms,
+            table="SPECTRAL_WINDOW",
+            colname="CHAN_FREQ"
+        )
+    )
+    uv_distance = np.hypot(uvw[0, :], uvw[1, :])
+
+    # NOTE: A row is kept only if it is inside the uv-range at every channel,
+    # so that all row-aligned products stay aligned.
+    uvmin, uvmax = uvrange
+    mask = np.ones(uv_distance.shape, dtype=bool)
+    if uvmin is not None:
+        mask &= convert_array_to_wavelengths(array=uv_distance, frequency=np.min(chan_freq)) >= uvmin
+    if uvmax is not None:
+        mask &= convert_array_to_wavelengths(array=uv_distance, frequency=np.max(chan_freq)) <= uvmax
+
+    return mask
+
+def export_uv_range(ms, filenames, uvrange, nrow_chunk=100000):
+    if all(product_exists(filename=filename) for filename in filenames.values()):
+        print(
+            "{} already exist".format(", ".join(filenames.values()))
+        )
+        return
+    mask = get_uv_range_mask(ms=ms, uvrange=uvrange)
+    nrow = int(np.count_nonzero(mask))
+    print(
+        "uv-range {}: {} of {} rows".format(uvrange, nrow, mask.size)
+    )
+    chan_freq = np.atleast_1d(
+        getcol_wrapper(
+            ms=ms,
+            table="SPECTRAL_WINDOW",
+            colname="CHAN_FREQ"
+        )
+    )
+    num_corr = int(
+        np.atleast_1d(
+            getcol_wrapper(ms=ms, table="POLARIZATION", colname="NUM_CORR")
+        )[0]
+    )
+    datatype, _, _ = get_data_manager_info(ms=ms)
+    visibilities = open_chunked_writer(
+        filename=filenames["visibilities"],
+        shape=(num_corr, chan_freq.size, nrow, 2),
+        dtype=np.float32 if datatype == "complex" else np.float64
+    )
+    uv_wavelengths = open_chunked_writer(
+        filename=filenames["uv_wavelengths"],
+        shape=(chan_freq.size, nrow, 2),
+        dtype=np.float64
+    )
+    antennas = open_chunked_writer(
+        filename=filenames["antennas"],
+        shape=(2, nrow),
+        dtype=np.int32
+    )
+    scans = open_chunked_writer(
+        filename=filenames["scans"],
+        shape=(nrow, ),
+        dtype=np.int32
+    )
+    offset = 0
+    for startrow, cols in iter_col_chunks(
+        ms=ms,
+        table="",
+        colnames=["DATA", "UVW", "ANTENNA1", "ANTENNA2", "SCAN_NUMBER"],
+        nrow_chunk=nrow_chunk
     ):
-        if not os.path.isdir(
-            "uid___{}.ms.split.cal".format(uid)
-        ):
-            raise NotImplementedError()
-        else:
-            split(
-                vis="uid___{}.ms.split.cal".format(
-                    uid
+        keep = mask[startrow:startrow + cols["UVW"].shape[-1]]
+        n = int(np.count_nonzero(keep))
+        if n == 0:
+            continue
+        rows = slice(offset, offset + n)
+        data = cols["DATA"][:, :, keep]
+        visibilities[:, :, rows, 0] = data.real
+        visibilities[:, :, rows, 1] = data.imag
+        uv_wavelengths[:, rows, :] = np.moveaxis(
+            convert_array_to_wavelengths(
+                array=cols["UVW"][:2, np.newaxis, keep],
+                frequency=chan_freq[np.newaxis, :, np.newaxis]
+            ),
+            0,
+            -1
+        )
+        antennas[0, rows] = cols["ANTENNA1"][keep]
+        antennas[1, rows] = cols["ANTENNA2"][keep]
+        scans[rows] = cols["SCAN_NUMBER"][keep]
+        offset += n
+    for product, array in zip(
+        ["visibilities", "uv_wavelengths", "antennas", "scans"],
+        [visibilities, uv_wavelengths, antennas, scans]
+    ):
+        close_chunked_writer(filename=filenames[product], array=array)
+
+def get_radial_profile(ms, bins, uvrange=None, nrow_chunk=100000):
+    bins = np.asarray(bins, dtype=float)
+    nbins = bins.size - 1
+    chan_freq = np.atleast_1d(
+        getcol_wrapper(
+            ms=ms,
+            table="SPECTRAL_WINDOW",
+            colname="CHAN_FREQ"
+        )
+    )
+    nchan = chan_freq.size
+    sums = np.zeros(
+        shape=(5, nchan * nbins)
+    )
+    channels = np.arange(nchan)[:, np.newaxis]
+    for startrow, cols in iter_col_chunks(
+        ms=ms,
+        table="",
+        colnames=["DATA", "FLAG", "WEIGHT", "UVW"],
+        nrow_chunk=nrow_chunk
+    ):
+        # NOTE: Correlations are combined with their weights (i.e. Stokes I for
+        # parallel hands) and flagged channels get zero weight.
+        weights = cols["WEIGHT"][:, np.newaxis, :] * ~cols["FLAG"]
+        sum_weights = np.sum(weights, axis=0)
+        sum_real = np.sum(weights * cols["DATA"].real, axis=0)
+        sum_imag = np.sum(weights * cols["DATA"].imag, axis=0)
+        uv_distance = convert_array_to_wavelengths(
+            array=np.hypot(cols["UVW"][0, :], cols["UVW"][1, :])[np.newaxis, :],
+            frequency=chan_freq[:, np.newaxis]
+        )
+        index = np.digitize(uv_distance, bins) - 1
+        valid = (index >= 0) & (index < nbins) & (sum_weights > 0)
+        if uvrange is not None:
+            uvmin, uvmax = uvrange
+            if uvmin is not None:
+                valid &= uv_distance >= uvmin
+            if uvmax is not None:
+                valid &= uv_distance <= uvmax
+        flat = (channels * nbins + index)[valid]
+        for i, values in enumerate([
+            sum_weights,
+            sum_weights * uv_distance,
+            sum_real,
+            sum_imag,
+            np.ones(valid.shape),
+        ]):
+            sums[i] += np.bincount(
+                flat,
+                weights=values[valid],
+                minlength=nchan * nbins
+            )
+    sum_weights, sum_uv_distance, sum_real, sum_imag, counts = sums.reshape(5, nchan, nbins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        real = sum_real / sum_weights
+        imag = sum_imag / sum_weights
+        profile = {
+            "uv_distance": sum_uv_distance / sum_weights,
+            "real": real,
+            "imag": imag,
+            "amplitude": np.hypot(real, imag),
+            "sigma": 1.0 / np.sqrt(sum_weights),
+            "counts": counts,
+        }
+
+    return profile
+
+def export_radial_profile(ms, filename, bins, uvrange=None):
+    profile = get_radial_profile(
+        ms=ms,
+        bins=bins,
+        uvrange=uvrange
+    )
+    radial_profile = np.stack(
+        arrays=(
+            profile["uv_distance"],
+            profile["real"],
+            profile["imag"],
+            profile["sigma"],
+            profile["counts"],
+        ),
+        axis=-1
+    )
+    print(
+        "shape (radial_profile):", radial_profile.shape
+    )
+    if astropy_is_imported:
+        fits.writeto(
+            filename=filename + ".fits",
+            data=radial_profile,
+            overwrite=True
+        )
+    else:
+        with open(filename + ".numpy", 'wb') as file:
+            np.save(file, radial_profile)
+
+def average_channels(data, flag, width):
+    # NOTE: Unflagged channels are averaged in bins of width channels (the last
+    # bin may be partial); bins without unflagged channels are flagged.
+    starts = np.arange(0, data.shape[1], width)
+    unflagged = ~flag
+    counts = np.add.reduceat(unflagged, starts, axis=1)
+    sums = np.add.reduceat(
+        np.where(unflagged, data, 0.0), starts, axis=1
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        averaged = np.where(counts > 0, sums / counts, 0.0)
+
+    return averaged, counts == 0
+
+def average_frequencies(chan_freq, width):
+    starts = np.arange(0, chan_freq.size, width)
+
+    return np.add.reduceat(chan_freq, starts) / np.add.reduceat(np.ones(chan_freq.size), starts)
+
+def load_product(filename):
+    if os.path.isfile(filename + ".numpy"):
+        return np.load(filename + ".numpy", mmap_mode="r")
+    elif os.path.isfile(filename + ".fits") and astropy_is_imported:
+        return fits.getdata(filename + ".fits", memmap=True)
+    else:
+        raise IOError(
+            "{} does not exist".format(filename)
+        )
+
+def get_grid_radians(shape_native, pixel_scales):
+    # NOTE: Pixel centres in (y, x), as PyAutoLens, with y decreasing with the
+    # row index and the origin at the centre of the grid.
+    arcsec_to_radians = np.pi / 180.0 / 3600.0
+    y = ((shape_native[0] - 1) / 2.0 - np.arange(shape_native[0])) * pixel_scales[0] * arcsec_to_radians
+    x = (np.arange(shape_native[1]) - (shape_native[1] - 1) / 2.0) * pixel_scales[1] * arcsec_to_radians
+
+    return np.stack(
+        arrays=np.meshgrid(y, x, indexing="ij"),
+        axis=-1
+    ).reshape(-1, 2)
+
+def get_transform_plan_key(uv_wavelengths, shape_native, pixel_scales, method, oversampling, support, nvis_chunk=1000000):
+    sha = hashlib.sha1()
+    for i in range(0, uv_wavelengths.shape[0], nvis_chunk):
+        sha.update(
+            np.ascontiguousarray(uv_wavelengths[i:i + nvis_chunk], dtype="<f8").tobytes()
+        )
+    sha.update(
+        repr((tuple(shape_native), tuple(pixel_scales), method, oversampling, support)).encode()
+    )
+
+    return sha.hexdigest()[:16]
+
+def kaiser_bessel(x, support, beta):
+    return np.where(
+        np.abs(x) <= support / 2.0,
+        np.i0(beta * np.sqrt(np.clip(1.0 - (2.0 * x / support) ** 2.0, 0.0, None))) / support,
+        0.0
+    )
+
+def export_transform_plan(filename, shape_native, pixel_scales, method="nufft", directory="transform_plans", oversampling=2, support=6, nvis_chunk=10000):
+    # NOTE: method="dft" stores the phase tables cos/sin(-2 pi (u x + v y)) of
+    # every visibility and pixel (small grids only), method="nufft" the
+    # Kaiser-Bessel interpolation weights onto the oversampled uv-grid and the
+    # deapodization of the image; either is keyed by a hash of the uv coverage,
+    # of the grid and of the kernel, so fits that share them share the plan.
+    uv_wavelengths = load_product(filename=filename)
+    uv_wavelengths = uv_wavelengths.reshape(-1, 2)
+    nvis = uv_wavelengths.shape[0]
+    key = get_transform_plan_key(
+        uv_wavelengths=uv_wavelengths,
+        shape_native=shape_native,
+        pixel_scales=pixel_scales,
+        method=method,
+        oversampling=oversampling,
+        support=support
+    )
+    plan_directory = "{}/{}".format(directory, key)
+    if os.path.isfile("{}/plan.json".format(plan_directory)):
+        print(
+            "{} already exists".format(plan_directory)
+        )
+        return key
+    if not os.path.isdir(plan_directory):
+        os.makedirs(plan_directory)
+
+    metadata = {
+        "uv_wavelengths": filename,
+        "nvis": nvis,
+        "shape_native": list(shape_native),
+        "pixel_scales": list(pixel_scales),
+        "method": method,
+    }
+    if method == "dft":
+        grid = get_grid_radians(shape_native=shape_native, pixel_scales=pixel_scales)
+        tables = [
+            open_chunked_writer(
+                filename="{}/{}".format(plan_directory, table),
+                shape=(nvis, grid.shape[0]),
+                dtype=np.float64
+            )
+            for table in ["cos", "sin"]
+        ]
+        for i in range(0, nvis, nvis_chunk):
+            uv = np.asarray(uv_wavelengths[i:i + nvis_chunk], dtype=np.float64)
+            phase = -2.0 * np.pi * (
+                uv[:, 0:1] * grid[np.newaxis, :, 1] + uv[:, 1:2] * grid[np.newaxis, :, 0]
+            )
+            tables[0][i:i + nvis_chunk] = np.cos(phase)
+            tables[1][i:i + nvis_chunk] = np.sin(phase)
+        for table, array in zip(["cos", "sin"], tables):
+            close_chunked_writer(
+                filename="{}/{}".format(plan_directory, table),
+                array=array
+            )
+    elif method == "nufft":
+        arcsec_to_radians = np.pi / 180.0 / 3600.0
+        shape_oversampled = [oversampling * n for n in shape_native]
+        cell_sizes = [
+            1.0 / (n * pixel_scale * arcsec_to_radians)
+            for n, pixel_scale in zip(shape_oversampled, pixel_scales)
+        ]
+        beta = np.pi * np.sqrt(
+            (support / oversampling) ** 2.0 * (oversampling - 0.5) ** 2.0 - 0.8
+        )
+        offsets = np.arange(support) - support // 2 + 1
+        indices = open_chunked_writer(
+            filename="{}/indices".format(plan_directory),
+            shape=(nvis, support * support),
+            dtype=np.int64
+        )
+        weights = open_chunked_writer(
+            filename="{}/weights".format(plan_directory),
+            shape=(nvis, support * support),
+            dtype=np.complex128
+        )
+        for i in range(0, nvis, nvis_chunk):
+            uv = np.asarray(uv_wavelengths[i:i + nvis_chunk], dtype=np.float64)
+
+            # NOTE: -v runs along the rows (y decreases with the row index) and u
+            # along the columns of the uv-grid, whose zero frequency is at index 0
+            # (i.e. unshifted FFT, with the image centred on pixel n // 2). The
+            # phase term moves the centre to (n - 1) / 2, as the grid of the DFT.
+            kernels = []
+            phase = np.zeros(uv.shape[0])
+            for coordinate, cell_size, n, pixel_scale in zip(
+                [-uv[:, 1], uv[:, 0]], cell_sizes, shape_oversampled, pixel_scales
+            ):
+                k = coordinate / cell_size
+                neighbours = np.floor(k)[:, np.newaxis] + offsets[np.newaxis, :]
+                kernels.append((
+                    np.mod(neighbours, n).astype(np.int64),
+                    kaiser_bessel(k[:, np.newaxis] - neighbours, support=support, beta=beta)
+                ))
+                phase -= 2.0 * np.pi * coordinate * (
+                    n // oversampling // 2 - (n // oversampling - 1) / 2.0
+                ) * pixel_scale * arcsec_to_radians
+            (index_y, weight_y), (index_x, weight_x) = kernels
+            indices[i:i + nvis_chunk] = (
+                index_y[:, :, np.newaxis] * shape_oversampled[1] + index_x[:, np.newaxis, :]
+            ).reshape(-1, support * support)
+            weights[i:i + nvis_chunk] = (
+                weight_y[:, :, np.newaxis] * weight_x[:, np.newaxis, :]
+            ).reshape(-1, support * support) * np.exp(1j * phase)[:, np.newaxis]
+        close_chunked_writer(filename="{}/indices".format(plan_directory), array=indices)
+        close_chunked_writer(filename="{}/weights".format(plan_directory), array=weights)
+
+        # NOTE: The Fourier transform of the kernel at each image pixel (computed
+        # by quadrature), by which the image is divided before the FFT.
+        t = np.linspace(-support / 2.0, support / 2.0, 100 * support + 1)
+        kernel = kaiser_bessel(t, support=support, beta=beta)
+        deapodization = np.ones(shape_native)
+        for axis, (n, n_oversampled) in enumerate(zip(shape_native, shape_oversampled)):
+            correction = np.sum(
+                kernel[np.newaxis, :] * np.cos(
+                    2.0 * np.pi * t[np.newaxis, :] * (np.arange(n) - n // 2)[:, np.newaxis] / n_oversampled
                 ),
-                outputvis="uid___{}_{}.ms.split.cal".format(
-                    uid,
-                    field
+                axis=1
+            ) * (t[1] - t[0])
+            deapodization *= correction.reshape(
+                [-1 if i == axis else 1 for i in range(len(shape_native))]
+            )
+        with open("{}/deapodization.numpy".format(plan_directory), 'wb') as file:
+            np.save(file, deapodization)
+        metadata.update({
+            "oversampling": oversampling,
+            "shape_oversampled": shape_oversampled,
+            "support": support,
+            "beta": beta,
+        })
+    else:
+        raise ValueError(
+            "method must be either \"dft\" or \"nufft\", not {}".format(method)
+        )
+
+    # NOTE: Written last, so that an interrupted export is not mistaken for a plan.
+    with open("{}/plan.json".format(plan_directory), 'w') as file:
+        json.dump(metadata, file, indent=4)
+    print(
+        "transform plan ({}): {}".format(method, plan_directory)
+    )
+
+    return key
+
+def load_transform_plan(key, directory="transform_plans"):
+    plan_directory = "{}/{}".format(directory, key)
+    if not os.path.isfile("{}/plan.json".format(plan_directory)):
+        raise IOError(
+            "{} does not exist".format(plan_directory)
+        )
+    with open("{}/plan.json".format(plan_directory), 'r') as file:
+        plan = json.load(file)
+    for name in os.listdir(plan_directory):
+        for extension in [".numpy", ".fits"]:
+            if name.endswith(extension):
+                plan[name[:-len(extension)]] = load_product(
+                    filename="{}/{}".format(plan_directory, name[:-len(extension)])
+                )
+
+    return plan
+
+def getcell_wrapper(ms, table, colname, row):
+    if os.path.isdir(ms):
+        tb.open(
+            "{}/{}".format(ms, table)
+        )
+        cell = tb.getcell(colname, row)
+        tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+
+    return cell
+
+def iter_selected_rows(ms, table, colnames, selections, nrow_chunk=100000):
+    # NOTE: selections maps a key to a boolean mask of the rows of the table.
+    # The table is walked once in chunks of rows, and the rows of each key
+    # within a chunk are read with selectrows, so that keys whose cells differ
+    # in shape (e.g. spws with different numbers of channels) can be read
+    # together, and rows that are not selected are not read at all. Each
+    # selection is yielded with its row numbers.
+    if os.path.isdir(ms):
+        tb.open(
+            "{}/{}".format(ms, table)
+        )
+        try:
+            nrows = tb.nrows()
+            for startrow in range(0, nrows, nrow_chunk):
+                for key, selection in selections.items():
+                    rownrs = startrow + np.flatnonzero(selection[startrow:startrow + nrow_chunk])
+                    if rownrs.size == 0:
+                        continue
+                    tb_selection = tb.selectrows(rownrs.tolist())
+                    try:
+                        yield key, rownrs, {
+                            colname: tb_selection.getcol(colname)
+                            for colname in colnames
+                        }
+                    finally:
+                        tb_selection.close()
+        finally:
+            tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+
+def export_demultiplexed(ms, fields, widths, filename_format, nrow_chunk=100000):
+    # NOTE: One sequential pass over the main table of the parent ms, routing
+    # each row by (FIELD_ID, DATA_DESC_ID) to the products of its (field, spw),
+    # instead of a split (i.e. a pass) per field and spw. widths maps each spw
+    # to its own width, e.g. {"25": 960, "31": 30}. filename_format is formatted
+    # with product, field, spw and width, e.g.
+    # "{product}_A002_X11adad7_Xdfdb_{field}_spw_{spw}_width_{width}".
+    field_names = list(
+        np.atleast_1d(
+            getcol_wrapper(ms=ms, table="FIELD", colname="NAME")
+        )
+    )
+    spw_ids = list(
+        np.atleast_1d(get_spw_ids(ms=ms))
+    )
+    polarization_ids = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="DATA_DESCRIPTION", colname="POLARIZATION_ID")
+    )
+    num_corr = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="POLARIZATION", colname="NUM_CORR")
+    )
+    field_ids = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="", colname="FIELD_ID")
+    )
+    data_desc_ids = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="", colname="DATA_DESC_ID")
+    )
+    flag_row = np.atleast_1d(
+        getcol_wrapper(ms=ms, table="", colname="FLAG_ROW")
+    )
+    datatype, _, _ = get_data_manager_info(ms=ms)
+
+    outputs = {}
+    for field in fields:
+        for spw, width in widths.items():
+            key = (field_names.index(field), spw_ids.index(int(spw)))
+            frequencies = average_frequencies(
+                chan_freq=np.atleast_1d(
+                    getcell_wrapper(ms=ms, table="SPECTRAL_WINDOW", colname="CHAN_FREQ", row=int(spw))
+                ),
+                width=width
+            )
+            filenames = {
+                product: filename_format.format(product=product, field=field, spw=spw, width=width)
+                for product in ["visibilities", "uv_wavelengths", "antennas", "scans"]
+            }
+            if all(product_exists(filename=filename) for filename in filenames.values()):
+                print(
+                    "field {}, spw {} already exists".format(field, spw)
+                )
+                continue
+            outputs[key] = {
+                "field": field,
+                "spw": spw,
+                "width": width,
+                "rows": (field_ids == key[0]) & (data_desc_ids == key[1]) & ~flag_row,
+                "filenames": filenames,
+                "offset": 0,
+                "frequencies": frequencies,
+            }
+    if not outputs:
+        return
+
+    # NOTE: As split(..., keepflags=False), rows whose every FLAG is set are not
+    # exported; FLAG_ROW is often not set for them, so they are found with a
+    # pass over FLAG alone, before the products are sized.
+    for key, rownrs, cols in iter_selected_rows(
+        ms=ms,
+        table="",
+        colnames=["FLAG"],
+        selections={key: output["rows"] for key, output in outputs.items()},
+        nrow_chunk=nrow_chunk
+    ):
+        outputs[key]["rows"][rownrs] = ~np.all(cols["FLAG"], axis=(0, 1))
+    for key, output in outputs.items():
+        nrow = int(np.count_nonzero(output["rows"]))
+        output.update({
+            "visibilities": open_chunked_writer(
+                filename=output["filenames"]["visibilities"],
+                shape=(int(num_corr[polarization_ids[key[1]]]), output["frequencies"].size, nrow, 2),
+                dtype=np.float32 if datatype == "complex" else np.float64
+            ),
+            "uv_wavelengths": open_chunked_writer(
+                filename=output["filenames"]["uv_wavelengths"],
+                shape=(output["frequencies"].size, nrow, 2),
+                dtype=np.float64
+            ),
+            "antennas": open_chunked_writer(
+                filename=output["filenames"]["antennas"],
+                shape=(2, nrow),
+                dtype=np.int32
+            ),
+            "scans": open_chunked_writer(
+                filename=output["filenames"]["scans"],
+                shape=(nrow, ),
+                dtype=np.int32
+            ),
+        })
+    for key, _, cols in iter_selected_rows(
+        ms=ms,
+        table="",
+        colnames=["DATA", "FLAG", "UVW", "ANTENNA1", "ANTENNA2", "SCAN_NUMBER"],
+        selections={key: output["rows"] for key, output in outputs.items()},
+        nrow_chunk=nrow_chunk
+    ):
+        output = outputs[key]
+        n = cols["UVW"].shape[-1]
+        rows = slice(output["offset"], output["offset"] + n)
+        averaged, _ = average_channels(
+            data=cols["DATA"],
+            flag=cols["FLAG"],
+            width=output["width"]
+        )
+        output["visibilities"][:, :, rows, 0] = averaged.real
+        output["visibilities"][:, :, rows, 1] = averaged.imag
+        output["uv_wavelengths"][:, rows, :] = np.moveaxis(
+            convert_array_to_wavelengths(
+                array=cols["UVW"][:2, np.newaxis, :],
+                frequency=output["frequencies"][np.newaxis, :, np.newaxis]
+            ),
+            0,
+            -1
+        )
+        output["antennas"][0, rows] = cols["ANTENNA1"]
+        output["antennas"][1, rows] = cols["ANTENNA2"]
+        output["scans"][rows] = cols["SCAN_NUMBER"]
+        output["offset"] += n
+    for output in outputs.values():
+        for product in ["visibilities", "uv_wavelengths", "antennas", "scans"]:
+            close_chunked_writer(filename=output["filenames"][product], array=output[product])
+        print(
+            "field {}, spw {}, width {} (visibilities):".format(output["field"], output["spw"], output["width"]), output["visibilities"].shape
+        )
+
+def lexicographic_less_equal(keys, threshold):
+    less = np.zeros(keys.shape[0], dtype=bool)
+    equal = np.ones(keys.shape[0], dtype=bool)
+    for j in range(keys.shape[1]):
+        less |= equal & (keys[:, j] < threshold[j])
+        equal &= keys[:, j] == threshold[j]
+
+    return less | equal
+
+def lexicographic_sort(keys):
+    return keys[np.lexsort(keys.T[::-1])]
+
+def get_baseline_time_permutation(ms, filename, max_memory=1.0e9, directory=None):
+    # NOTE: External merge sort of the rows by (ANTENNA1, ANTENNA2, TIME, row),
+    # i.e. by baseline and then time. Sorted runs of the keys are written to
+    # disk and merged in blocks, so that at most ~max_memory bytes of keys are
+    # in memory at once. The permutation holds, for each sorted row, its row in
+    # the ms (i.e. sorted = original.take(permutation, axis=row_axis)).
+    if product_exists(filename=filename):
+        return load_product(filename=filename)
+    nrow_run = max(int(max_memory // 64), 1)
+    run_directory = tempfile.mkdtemp(dir=directory)
+    try:
+        runs = []
+        for startrow, cols in iter_col_chunks(
+            ms=ms,
+            table="",
+            colnames=["ANTENNA1", "ANTENNA2", "TIME"],
+            nrow_chunk=nrow_run
+        ):
+            keys = np.stack(
+                arrays=(
+                    cols["ANTENNA1"],
+                    cols["ANTENNA2"],
+                    cols["TIME"],
+                    np.arange(startrow, startrow + cols["TIME"].size),
                 ),
-                keepmms=True,
-                field=field,
-                spw="",
-                datacolumn="data",
-                keepflags=False
+                axis=-1
+            ).astype(np.float64)
+            run = "{}/run_{}.numpy".format(run_directory, len(runs))
+            with open(run, 'wb') as file:
+                np.save(file, lexicographic_sort(keys))
+            runs.append(
+                np.load(run, mmap_mode="r")
+            )
+        nrow = sum(run.shape[0] for run in runs)
+        permutation = open_chunked_writer(
+            filename=filename,
+            shape=(nrow, ),
+            dtype=np.int64
+        )
+
+        # NOTE: Every element of a run that is not yet buffered is larger than the
+        # last element buffered from that run, so everything up to the smallest of
+        # these last elements can be merged and written out.
+        nrow_block = max(nrow_run // (len(runs) + 1), 1)
+        positions = [0] * len(runs)
+        buffers = [np.zeros((0, 4))] * len(runs)
+        offset = 0
+        while offset < nrow:
+            for i, run in enumerate(runs):
+                if buffers[i].shape[0] == 0 and positions[i] < run.shape[0]:
+                    buffers[i] = np.asarray(run[positions[i]:positions[i] + nrow_block])
+                    positions[i] += buffers[i].shape[0]
+            candidates = [
+                buffers[i][-1] for i, run in enumerate(runs) if positions[i] < run.shape[0]
+            ]
+            if candidates:
+                threshold = lexicographic_sort(np.array(candidates))[0]
+            else:
+                threshold = np.full(4, np.inf)
+            merged = []
+            for i in range(len(runs)):
+                mask = lexicographic_less_equal(buffers[i], threshold)
+                merged.append(buffers[i][mask])
+                buffers[i] = buffers[i][~mask]
+            merged = lexicographic_sort(np.concatenate(merged))
+            permutation[offset:offset + merged.shape[0]] = merged[:, 3].astype(np.int64)
+            offset += merged.shape[0]
+        close_chunked_writer(filename=filename, array=permutation)
+        del runs
+    finally:
+        shutil.rmtree(run_directory)
+
+    return load_product(filename=filename)
+
+def export_sorted_by_baseline(ms, filenames, filename_permutation, max_memory=1.0e9, directory=None):
+    # NOTE: filenames maps the row-aligned products of the ms (exported with all
+    # of its rows) to their filenames; each is written reordered to
+    # <filename>_baseline_time, gathering blocks of rows at a time.
+    row_axes = {
+        "visibilities": -2,
+        "uv_wavelengths": -2,
+        "sigma": -2,
+        "antennas": -1,
+        "scans": -1,
+    }
+    permutation = get_baseline_time_permutation(
+        ms=ms,
+        filename=filename_permutation,
+        max_memory=max_memory,
+        directory=directory
+    )
+    for product, filename in filenames.items():
+        if product_exists(filename=filename + "_baseline_time"):
+            print(
+                "{} already exists".format(filename + "_baseline_time")
+            )
+            continue
+        row_axis = row_axes[product]
+        array = load_product(filename=filename)
+        if array.shape[row_axis] != permutation.size:
+            raise ValueError(
+                "{} has {} rows, the ms {}".format(filename, array.shape[row_axis], permutation.size)
             )
+        output = open_chunked_writer(
+            filename=filename + "_baseline_time",
+            shape=array.shape,
+            dtype=array.dtype.newbyteorder("=")
+        )
+        nrow_block = max(
+            int(max_memory // (3 * array.itemsize * array.size // max(permutation.size, 1) + 1)), 1
+        )
+        for startrow in range(0, permutation.size, nrow_block):
+            rows = np.asarray(permutation[startrow:startrow + nrow_block])
+
+            # NOTE: Gathered in increasing row order, which is sequential on disk.
+            order = np.argsort(rows)
+            block = np.take(
+                np.take(array, rows[order], axis=row_axis),
+                np.argsort(order),
+                axis=row_axis
+            )
+            index = [slice(None)] * array.ndim
+            index[row_axis] = slice(startrow, startrow + rows.size)
+            output[tuple(index)] = block
+        close_chunked_writer(filename=filename + "_baseline_time", array=output)
+        print(
+            "shape ({}, sorted by baseline and time):".format(product), output.shape
+        )
+
+def write_metadata(filename, metadata):
+    with open(filename + ".json", 'w') as file:
+        json.dump(metadata, file, indent=4)
+
+def get_nrows(ms):
+    if os.path.isdir(ms):
+        tb.open(ms)
+        nrows = tb.nrows()
+        tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+
+    return nrows
+
+def get_phase_center(ms):
+    phase_dir = getcol_wrapper(
+        ms=ms,
+        table="FIELD",
+        colname="PHASE_DIR"
+    )
+
+    # NOTE: (ra, dec) in radians of the (first) field.
+    return np.reshape(phase_dir, (2, -1))[:, 0]
+
+def get_phase_shift_lmn(phase_center_ms, phase_center):
+    ra_0, dec_0 = phase_center_ms
+    ra, dec = phase_center
+    l = np.cos(dec) * np.sin(ra - ra_0)
+    m = np.sin(dec) * np.cos(dec_0) - np.cos(dec) * np.sin(dec_0) * np.cos(ra - ra_0)
+
+    return l, m, np.sqrt(1.0 - l ** 2.0 - m ** 2.0)
+
+def export_phase_shifted(ms, filename, phase_center, nrow_chunk=100000):
+    # NOTE: phase_center is the new (ra, dec) in degrees. The visibilities are
+    # rotated by exp(2 pi i (u l + v m + w (n - 1))), with (l, m, n) the new
+    # centre relative to the phase centre of the ms, one chunk of rows at a
+    # time; uvw are not reprojected, which holds for small offsets (e.g. of the
+    # lens centroid from the pointing).
+    phase_center_ms = get_phase_center(ms=ms)
+    l, m, n = get_phase_shift_lmn(
+        phase_center_ms=phase_center_ms,
+        phase_center=np.radians(phase_center)
+    )
+    chan_freq = np.atleast_1d(
+        getcol_wrapper(
+            ms=ms,
+            table="SPECTRAL_WINDOW",
+            colname="CHAN_FREQ"
+        )
+    )
+    # NOTE: Before the loop, as iter_col_chunks holds tb open while it runs.
+    nrows = get_nrows(ms=ms)
+    visibilities = None
+    for startrow, cols in iter_col_chunks(
+        ms=ms,
+        table="",
+        colnames=["DATA", "UVW"],
+        nrow_chunk=nrow_chunk
+    ):
+        data = cols["DATA"]
+        uvw = cols["UVW"]
+        if visibilities is None:
+            visibilities = open_chunked_writer(
+                filename=filename,
+                shape=(data.shape[0], chan_freq.size, nrows, 2),
+                dtype=data.real.dtype
+            )
+        phase = 2.0 * np.pi * convert_array_to_wavelengths(
+            array=(uvw[0] * l + uvw[1] * m + uvw[2] * (n - 1.0))[np.newaxis, :],
+            frequency=chan_freq[:, np.newaxis]
+        )
+        data = data * np.exp(1j * phase)[np.newaxis, :, :]
+        rows = slice(startrow, startrow + data.shape[-1])
+        visibilities[:, :, rows, 0] = data.real
+        visibilities[:, :, rows, 1] = data.imag
+    close_chunked_writer(filename=filename, array=visibilities)
+    print(
+        "shape (visibilities):", visibilities.shape
+    )
+    write_metadata(
+        filename=filename,
+        metadata={
+            "phase_center": list(phase_center),
+            "phase_center_ms": list(np.degrees(phase_center_ms)),
+            "lmn": [l, m, n],
+        }
+    )
+
+if __name__ == "__main__":
+    #uid = "A002_X11adad7_Xd8c1"
+    uid = "A002_X11adad7_Xdfdb"
+    field = "SPT0314-44"
     spws = [
         "25",
         "27",
@@ -379,124 +1683,421 @@ if __name__ == "__main__":
 
     # NOTE:
     width = 960
-    for spw in spws:
-        if not os.path.isdir(
-            "{}_{}_spw_{}_width_{}.ms.split.cal".format(
-                "uid___" + uid,
-                field,
-                spw,
-                width
+
+    # NOTE: Also estimate sigma (as statwt) from the scatter of the visibilities,
+    # at the cost of another pass over DATA.
+    estimate_sigma = False
+
+    # NOTE: Inclusive (start, stop) channel ranges left out of the estimate of sigma.
+    exclude_channels = None
+
+    # NOTE: Also write the row-aligned products sorted by (baseline, time).
+    sort_by_baseline = False
+
+    # NOTE: Publish the products to shared memory (see attach_shared_memory) instead of to disk.
+    use_shared_memory = False
+
+    # NOTE: Only export baselines within (uvmin, uvmax), in wavelengths; either bound can be None.
+    uvrange = None
+
+    # NOTE: Edges (in wavelengths) of the bins of the radial uv-distance profiles.
+    radial_bins = None
+
+    # NOTE: Export each spw at its own width (e.g. {"25": 960, "27": 960, "29": 960,
+    # "31": 30}) from one pass over the ms of the field instead. These are read
+    # from the calibrated ms, i.e. "31" at 30 is not continuum-subtracted; the
+    # line product still comes from main_uvcontsub_example.py.
+    single_pass_widths = None
+
+    # NOTE: Precompute the transform of the uv coverage for a real-space grid, e.g.
+    # {"shape_native": (256, 256), "pixel_scales": (0.05, 0.05), "method": "nufft"}.
+    transform_plan = None
+
+    # NOTE: Export every field and spw in one pass over the ms, without splitting it.
+    demultiplex = False
+
+    # NOTE: Rotate the visibilities to this (ra, dec) in degrees, e.g. the lens centroid.
+    phase_center = None
+
+    # NOTE: Processes reading the sub-MSs of a multi-MS (see the num_workers that
+    # plan_export suggests); None for one per CPU available.
+    num_workers = None
+
+    # NOTE: Only plan the run (sizes, memory, I/O) from the metadata of the ms.
+    dry_run = False
+
+    # NOTE: Only export_visibilities applies phase_center.
+    if phase_center is not None and (
+        use_shared_memory or uvrange is not None or radial_bins is not None or single_pass_widths is not None or demultiplex
+    ):
+        raise NotImplementedError(
+            "phase_center can not be combined with use_shared_memory, uvrange, radial_bins, single_pass_widths or demultiplex"
+        )
+
+    # NOTE: With uvrange, only the baselines within it are exported (to disk),
+    # which the row-aligned sigma and baseline/time ordering do not match.
+    if uvrange is not None and (estimate_sigma or sort_by_baseline or use_shared_memory):
+        raise NotImplementedError(
+            "uvrange can not be combined with estimate_sigma, sort_by_baseline or use_shared_memory"
+        )
+
+    # NOTE: Only the products of export_demultiplexed are exported in a single pass.
+    if single_pass_widths is not None and (
+        estimate_sigma or sort_by_baseline or transform_plan is not None or uvrange is not None or radial_bins is not None or use_shared_memory
+    ):
+        raise NotImplementedError(
+            "single_pass_widths can not be combined with estimate_sigma, sort_by_baseline, transform_plan, uvrange, radial_bins or use_shared_memory"
+        )
+    # NOTE: Only the products of export_demultiplexed are exported from the parent ms.
+    if demultiplex and (
+        estimate_sigma or sort_by_baseline or transform_plan is not None or uvrange is not None or radial_bins is not None or use_shared_memory or single_pass_widths is not None
+    ):
+        raise NotImplementedError(
+            "demultiplex can not be combined with estimate_sigma, sort_by_baseline, transform_plan, uvrange, radial_bins, use_shared_memory or single_pass_widths"
+        )
+    get_executor(num_workers=num_workers)
+    if dry_run:
+        plan_export(
+            ms="uid___{}_{}.ms.split.cal".format(uid, field) if os.path.isdir(
+                "uid___{}_{}.ms.split.cal".format(uid, field)
+            ) else "uid___{}.ms.split.cal".format(uid),
+            field=field,
+            spws=spws,
+            width=width
+        )
+    elif demultiplex:
+        export_demultiplexed(
+            ms="uid___{}.ms.split.cal".format(uid),
+            fields=[field],
+            widths={spw: width for spw in spws},
+            filename_format="{{product}}_{}_{{field}}_spw_{{spw}}_width_{{width}}".format(
+                uid
             )
+        )
+    else:
+        if not os.path.isdir(
+            "uid___{}_{}.ms.split.cal".format(uid, field)
         ):
-            split(
-                vis="uid___{}_{}.ms.split.cal".format(
+            if not os.path.isdir(
+                "uid___{}.ms.split.cal".format(uid)
+            ):
+                raise NotImplementedError()
+            else:
+                split(
+                    vis="uid___{}.ms.split.cal".format(
+                        uid
+                    ),
+                    outputvis="uid___{}_{}.ms.split.cal".format(
+                        uid,
+                        field
+                    ),
+                    keepmms=True,
+                    field=field,
+                    spw="",
+                    datacolumn="data",
+                    keepflags=False
+                )
+        if single_pass_widths is not None:
+            # ========== #
+            # NOTE: Every spw at its own width from a single pass over the ms of the field.
+            # ========== #
+            export_demultiplexed(
+                ms="uid___{}_{}.ms.split.cal".format(
                     uid,
                     field
                 ),
-                outputvis="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
-                    uid,
-                    field,
-                    spw,
-                    width
-                ),
-                keepmms=True,
-                field=field,
-                spw=spw,
-                datacolumn="data",
-                width=width,
-                keepflags=False
-            )
-
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename_uv_wavelengths = "uv_wavelengths_{}_{}_spw_{}_width_{}".format(
-            uid,
-            field,
-            spw,
-            width,
-        )
-        if os.path.isfile(filename_uv_wavelengths + ".fits") or os.path.isfile(filename_uv_wavelengths + ".numpy"):
-            pass
-        else:
-            export_uv_wavelengths(
-                ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
-                    uid,
-                    field,
-                    spw,
-                    width
-                ),
-                filename=filename_uv_wavelengths
+                fields=[field],
+                widths=single_pass_widths,
+                filename_format="{{product}}_{}_{{field}}_spw_{{spw}}_width_{{width}}".format(
+                    uid
+                )
             )
-        # ========== #
-        # END
-        # ========== #
-
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename_visibilities = "visibilities_{}_{}_spw_{}_width_{}".format(
-            uid,
-            field,
-            spw,
-            width,
-        )
-        if os.path.isfile(filename_visibilities + ".fits") or os.path.isfile(filename_visibilities + ".numpy"):
-            pass
+            # ========== #
+            # END
+            # ========== #
         else:
-            export_visibilities(
-                ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
-                    uid,
-                    field,
-                    spw,
-                    width
-                ),
-                filename=filename_visibilities
-            )
-        # ========== #
-        # END
-        # ========== #
-
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename = "antennas_{}_{}_spw_{}_width_{}".format(
-            uid,
-            field,
-            spw,
-            width
-        )
-        export_antennas(
-            ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
-                uid,
-                field,
-                spw,
-                width
-            ),
-            filename=filename
-        )
-        # ========== #
-        # END
-        # ========== #
-
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename = "scans_{}_{}_spw_{}_width_{}".format(
-            uid,
-            field,
-            spw,
-            width
-        )
-        export_scans(
-            ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
-                uid,
-                field,
-                spw,
-                width
-            ),
-            filename=filename
-        )
-        # ========== #
-        # END
-        # ========== #
+            for spw in spws:
+                if not os.path.isdir(
+                    "{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                        "uid___" + uid,
+                        field,
+                        spw,
+                        width
+                    )
+                ):
+                    split(
+                        vis="uid___{}_{}.ms.split.cal".format(
+                            uid,
+                            field
+                        ),
+                        outputvis="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        keepmms=True,
+                        field=field,
+                        spw=spw,
+                        datacolumn="data",
+                        width=width,
+                        keepflags=False
+                    )
+
+                # ========== #
+                # NOTE: Publish the products to shared memory instead of writing them to disk.
+                # ========== #
+                if use_shared_memory:
+                    export_shared_memory(
+                        ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        name="{}_{}_spw_{}_width_{}".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        )
+                    )
+                    continue
+                # ========== #
+                # END
+                # ========== #
+
+                if uvrange is not None:
+                    # ========== #
+                    # NOTE: Only the baselines within the uv-range, written in a single pass over the ms.
+                    # ========== #
+                    export_uv_range(
+                        ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        filenames={
+                            product: "{}_{}_{}_spw_{}_width_{}_uvrange_{}_{}".format(
+                                product,
+                                uid,
+                                field,
+                                spw,
+                                width,
+                                *uvrange
+                            )
+                            for product in ["visibilities", "uv_wavelengths", "antennas", "scans"]
+                        },
+                        uvrange=uvrange
+                    )
+                    filename_uv_wavelengths = "uv_wavelengths_{}_{}_spw_{}_width_{}_uvrange_{}_{}".format(
+                        uid,
+                        field,
+                        spw,
+                        width,
+                        *uvrange
+                    )
+                    # ========== #
+                    # END
+                    # ========== #
+                else:
+                    # ========== #
+                    # NOTE: ...
+                    # ========== #
+                    filename_uv_wavelengths = "uv_wavelengths_{}_{}_spw_{}_width_{}".format(
+                        uid,
+                        field,
+                        spw,
+                        width,
+                    )
+                    if os.path.isfile(filename_uv_wavelengths + ".fits") or os.path.isfile(filename_uv_wavelengths + ".numpy"):
+                        pass
+                    else:
+                        export_uv_wavelengths(
+                            ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                                uid,
+                                field,
+                                spw,
+                                width
+                            ),
+                            filename=filename_uv_wavelengths
+                        )
+                    # ========== #
+                    # END
+                    # ========== #
+
+                    # ========== #
+                    # NOTE: ...
+                    # ========== #
+                    filename_visibilities = "visibilities_{}_{}_spw_{}_width_{}".format(
+                        uid,
+                        field,
+                        spw,
+                        width,
+                    )
+                    if phase_center is not None:
+                        filename_visibilities += "_phase_center_{}_{}".format(*phase_center)
+                    if os.path.isfile(filename_visibilities + ".fits") or os.path.isfile(filename_visibilities + ".numpy"):
+                        pass
+                    else:
+                        export_visibilities(
+                            ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                                uid,
+                                field,
+                                spw,
+                                width
+                            ),
+                            filename=filename_visibilities,
+                            phase_center=phase_center
+                        )
+                    # ========== #
+                    # END
+                    # ========== #
+
+                    # ========== #
+                    # NOTE: ...
+                    # ========== #
+                    filename = "antennas_{}_{}_spw_{}_width_{}".format(
+                        uid,
+                        field,
+                        spw,
+                        width
+                    )
+                    export_antennas(
+                        ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        filename=filename
+                    )
+                    # ========== #
+                    # END
+                    # ========== #
+
+                    # ========== #
+                    # NOTE: ...
+                    # ========== #
+                    filename = "scans_{}_{}_spw_{}_width_{}".format(
+                        uid,
+                        field,
+                        spw,
+                        width
+                    )
+                    export_scans(
+                        ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        filename=filename
+                    )
+                    # ========== #
+                    # END
+                    # ========== #
+
+                # ========== #
+                # NOTE: Transform plan of the uv coverage, shared by every fit on this grid.
+                # ========== #
+                if transform_plan is not None:
+                    export_transform_plan(
+                        filename=filename_uv_wavelengths,
+                        **transform_plan
+                    )
+                # ========== #
+                # END
+                # ========== #
+
+                # ========== #
+                # NOTE: Empirical sigma (as statwt) estimated from the visibilities.
+                # ========== #
+                if estimate_sigma:
+                    export_sigma(
+                        ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        filename="sigma_{}_{}_spw_{}_width_{}".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        exclude_channels=exclude_channels
+                    )
+                # ========== #
+                # END
+                # ========== #
+
+                # ========== #
+                # NOTE: Row-aligned products reordered by baseline and time.
+                # ========== #
+                if sort_by_baseline:
+                    export_sorted_by_baseline(
+                        ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        ),
+                        filenames=dict(
+                            {
+                                product: "{}_{}_{}_spw_{}_width_{}".format(
+                                    product,
+                                    uid,
+                                    field,
+                                    spw,
+                                    width
+                                )
+                                for product in ["uv_wavelengths", "antennas", "scans"] + (["sigma"] if estimate_sigma else [])
+                            },
+                            visibilities=filename_visibilities
+                        ),
+                        filename_permutation="permutation_{}_{}_spw_{}_width_{}".format(
+                            uid,
+                            field,
+                            spw,
+                            width
+                        )
+                    )
+                # ========== #
+                # END
+                # ========== #
+
+                # ========== #
+                # NOTE: ...
+                # ========== #
+                if radial_bins is not None:
+                    filename = "radial_profile_{}_{}_spw_{}_width_{}_bins_{}_{}_{}".format(
+                        uid,
+                        field,
+                        spw,
+                        width,
+                        radial_bins[0],
+                        radial_bins[-1],
+                        len(radial_bins) - 1
+                    )
+                    if uvrange is not None:
+                        filename += "_uvrange_{}_{}".format(*uvrange)
+                    if os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy"):
+                        pass
+                    else:
+                        export_radial_profile(
+                            ms="uid___{}_{}_spw_{}_width_{}.ms.split.cal".format(
+                                uid,
+                                field,
+                                spw,
+                                width
+                            ),
+                            filename=filename,
+                            bins=radial_bins,
+                            uvrange=uvrange
+                        )
+                # ========== #
+                # END
+                # ========== #
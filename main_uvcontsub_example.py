@@ -1,5 +1,24 @@
+import json
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
+try:
+    from casatools import table as tbtool
+except:
+    pass # NOTE: CASA < 6 provides tbtool as a builtin.
+
+try:
+    from multiprocessing import (
+        shared_memory,
+        resource_tracker,
+    )
+    shared_memory_is_imported = True
+except:
+    shared_memory_is_imported = False
+
 try:
     from astropy import (
         units,
@@ -11,16 +30,79 @@ except:
     astropy_is_imported = False
 
 
-def getcol_wrapper(ms, table, colname):
+def get_mms_partitions(ms):
     if os.path.isdir(ms):
-        tb.open(
-            "{}/{}".format(ms, table)
+        tb.open(ms)
+        partitions = list(
+            tb.getpartnames()
         )
-        col = np.squeeze(
-            tb.getcol(colname)
+        tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
         )
 
-        tb.close()
+    # NOTE: The main table of a multi-MS concatenates its sub-MSs, and
+    # getpartnames returns them in the order of concatenation (i.e. row order).
+    return partitions if len(partitions) > 1 else []
+
+def getcol_partition(ms, table, colname):
+    tb_partition = tbtool()
+    tb_partition.open(
+        "{}/{}".format(ms, table)
+    )
+    col = tb_partition.getcol(colname)
+    tb_partition.close()
+
+    return col
+
+executors = {}
+
+def get_executor(num_workers=None):
+    # NOTE: A pool is forked once and reused by every read of the sub-MSs (e.g.
+    # of both ANTENNA1 and ANTENNA2 in get_antennas). num_workers=None reuses
+    # the pool already open (sized in __main__), else opens one with a worker
+    # per CPU this process may run on (as plan_export assumes); "fork" so that
+    # the workers see the functions of this script, which is exec'd rather
+    # than imported.
+    if num_workers is None:
+        if executors:
+            return next(iter(executors.values()))
+        num_workers = len(os.sched_getaffinity(0))
+    if num_workers not in executors:
+        executors[num_workers] = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("fork")
+        )
+        atexit.register(executors[num_workers].shutdown)
+
+    return executors[num_workers]
+
+def getcol_wrapper(ms, table, colname, num_workers=None):
+    if os.path.isdir(ms):
+        partitions = get_mms_partitions(ms=ms) if table == "" else []
+        if partitions:
+            # NOTE: Each sub-MS is read by its own process and table tool (the
+            # table tool holds the GIL).
+            cols = list(
+                get_executor(num_workers=num_workers).map(
+                    getcol_partition,
+                    partitions,
+                    [table] * len(partitions),
+                    [colname] * len(partitions)
+                )
+            )
+            col = np.squeeze(
+                np.concatenate(cols, axis=-1)
+            )
+        else:
+            tb.open(
+                "{}/{}".format(ms, table)
+            )
+            col = np.squeeze(
+                tb.getcol(colname)
+            )
+            tb.close()
     else:
         raise IOError(
             "{} does not exist".format(ms)
@@ -61,16 +143,46 @@ def get_visibilities(ms):
     return visibilities
 
 
-def export_visibilities(ms, filename):
+def export_visibilities(ms, filename, layout="native", phase_center=None, nrow_chunk=100000):
     if os.path.isfile(filename):
         print(
             "{} already exists".format(filename)
         )
+    elif phase_center is not None:
+        export_phase_shifted(
+            ms=ms,
+            filename=filename,
+            phase_center=phase_center,
+            layout=layout,
+            nrow_chunk=nrow_chunk
+        )
+    elif layout == "channel":
+        export_channel_major(
+            ms=ms,
+            filename=filename,
+            product="visibilities",
+            nrow_chunk=nrow_chunk
+        )
     else:
         visibilities = get_visibilities(ms=ms)
         print(
             "shape (visibilities):", visibilities.shape
         )
+        write_metadata(
+            filename=filename,
+            metadata=get_layout_metadata(
+                layout="native",
+                axes=["correlation", "channel", "row", "real_imag"],
+                shape=(
+                    np.atleast_1d(
+                        getcol_wrapper(ms=ms, table="POLARIZATION", colname="NUM_CORR")
+                    )[0],
+                    np.atleast_1d(get_num_chan(ms=ms))[0],
+                    get_nrows(ms=ms),
+                    2
+                )
+            )
+        )
         if astropy_is_imported:
             fits.writeto(
                 filename=filename + ".fits",
@@ -131,16 +243,35 @@ def get_uv_wavelengths(ms):
     return uv_wavelengths
 
 
-def export_uv_wavelengths(ms, filename):
+def export_uv_wavelengths(ms, filename, layout="native", nrow_chunk=100000):
     if os.path.isfile(filename):
         print(
             "{} already exists".format(filename)
         )
+    elif layout == "channel":
+        export_channel_major(
+            ms=ms,
+            filename=filename,
+            product="uv_wavelengths",
+            nrow_chunk=nrow_chunk
+        )
     else:
         uv_wavelengths = get_uv_wavelengths(ms=ms)
         print(
             "shape (uv_wavelengths):", uv_wavelengths.shape
         )
+        write_metadata(
+            filename=filename,
+            metadata=get_layout_metadata(
+                layout="native",
+                axes=["channel", "row", "uv"],
+                shape=(
+                    np.atleast_1d(get_num_chan(ms=ms))[0],
+                    get_nrows(ms=ms),
+                    2
+                )
+            )
+        )
         if astropy_is_imported:
             fits.writeto(
                 filename=filename + ".fits",
@@ -151,48 +282,295 @@ def export_uv_wavelengths(ms, filename):
             with open(filename + ".numpy", 'wb') as file:
                 np.save(file, uv_wavelengths)
 
-# def get_sigma(ms):
-#     if os.path.isdir(ms):
-#         sigma = getcol_wrapper(
-#             ms=ms,
-#             table="",
-#             colname="SIGMA"
-#         )
-#         chan_freq = getcol_wrapper(
-#             ms=ms,
-#             table="SPECTRAL_WINDOW",
-#             colname="CHAN_FREQ"
-#         )
-#         sigma = np.tile(
-#             sigma[:, np.newaxis, :], (1, len(chan_freq), 1)
-#         )
-#     else:
-#         raise IOError(
-#             "{} does not exisxt".format(ms)
-#         )
-#     return np.stack(
-#         arrays=(sigma, sigma),
-#         axis=-1
-#     )
-# def export_sigma(ms, filename):
-#     if os.path.isfile(filename):
-#         print(
-#             "{} already exists".format(filename)
-#         )
-#     else:
-#         sigma = get_sigma(ms=ms)
-#         print(
-#             "shape (sigma):", sigma.shape
-#         )
-#         if astropy_is_imported:
-#             fits.writeto(
-#                 filename=filename + ".fits",
-#                 data=sigma,
-#                 overwrite=True
-#             )
-#         else:
-#             with open(filename + ".numpy", 'wb') as file:
-#                 np.save(file, sigma)
+def iter_col_chunks(ms, table, colnames, nrow_chunk=100000):
+    if os.path.isdir(ms):
+        tb.open(
+            "{}/{}".format(ms, table)
+        )
+        try:
+            nrows = tb.nrows()
+            for startrow in range(0, nrows, nrow_chunk):
+                nrow = min(nrow_chunk, nrows - startrow)
+                yield startrow, {
+                    colname: tb.getcol(colname, startrow, nrow)
+                    for colname in colnames
+                }
+        finally:
+            tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+
+def get_fits_header(shape, dtype):
+    # NOTE: The primary header of an image of this shape and dtype; FITS lists
+    # the axes fastest first, i.e. in the reverse order of numpy.
+    header = fits.Header()
+    header["SIMPLE"] = True
+    header["BITPIX"] = {
+        "i2": 16,
+        "i4": 32,
+        "i8": 64,
+        "f4": -32,
+        "f8": -64,
+    }[np.dtype(dtype).str[1:]]
+    header["NAXIS"] = len(shape)
+    for i, n in enumerate(shape[::-1]):
+        header["NAXIS{}".format(i + 1)] = n
+    header["EXTEND"] = True
+
+    return header
+
+def open_chunked_writer(filename, shape, dtype):
+    # NOTE: Length-1 axes are left out of the file, as np.squeeze does for the
+    # in-memory exports, but kept in the returned view so that chunks can be
+    # assigned without squeezing them first. As the in-memory exports, the
+    # product is a .fits when astropy is imported: its header is written up
+    # front and the chunks straight into its (big-endian) data, so that it is
+    # never held in memory nor written twice (complex products, which FITS has
+    # no BITPIX for, stay .numpy). Until close_chunked_writer, the file is a
+    # .part, so that an interrupted export is not taken for a product.
+    shape_file = tuple(int(n) for n in shape if n != 1)
+    if astropy_is_imported and np.dtype(dtype).kind in "if":
+        header = get_fits_header(shape=shape_file, dtype=dtype).tostring().encode()
+        size = int(np.prod(shape_file)) * np.dtype(dtype).itemsize
+        with open(filename + ".fits.part", 'wb') as file:
+            file.write(header)
+            file.truncate(len(header) + -(-size // 2880) * 2880)
+        if size == 0:
+            return np.zeros(shape, dtype=dtype)
+        array = np.memmap(
+            filename + ".fits.part",
+            mode="r+",
+            dtype=np.dtype(dtype).newbyteorder(">"),
+            offset=len(header),
+            shape=shape_file
+        )
+    else:
+        array = np.lib.format.open_memmap(
+            filename + ".numpy.part",
+            mode="w+",
+            dtype=dtype,
+            shape=shape_file
+        )
+
+    return array.reshape(shape)
+
+def product_exists(filename):
+    return os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy")
+
+def close_chunked_writer(filename, array):
+    if isinstance(array, np.memmap):
+        array.flush()
+    for extension in [".fits", ".numpy"]:
+        if os.path.isfile(filename + extension + ".part"):
+            os.rename(filename + extension + ".part", filename + extension)
+
+def write_metadata(filename, metadata):
+    with open(filename + ".json", 'w') as file:
+        json.dump(metadata, file, indent=4)
+
+def get_layout_metadata(layout, axes, shape):
+    # NOTE: Length-1 axes are not stored (see open_chunked_writer), nor listed.
+    return {
+        "layout": layout,
+        "axes": [axis for axis, n in zip(axes, shape) if n != 1],
+        "shape": [int(n) for n in shape if n != 1],
+    }
+
+def get_nrows(ms):
+    if os.path.isdir(ms):
+        tb.open(ms)
+        nrows = tb.nrows()
+        tb.close()
+    else:
+        raise IOError(
+            "{} does not exist".format(ms)
+        )
+
+    return nrows
+
+def export_channel_major(ms, filename, product, nrow_chunk=100000):
+    # NOTE: Stored as (channel, row, ...), so that each channel is a contiguous
+    # block of the file; the transpose is done chunk by chunk while streaming.
+    chan_freq = np.atleast_1d(
+        get_frequencies(ms=ms)
+    )
+    nrows = get_nrows(ms=ms)
+    output = None
+    for startrow, cols in iter_col_chunks(
+        ms=ms,
+        table="",
+        colnames=["DATA"] if product == "visibilities" else ["UVW"],
+        nrow_chunk=nrow_chunk
+    ):
+        if product == "visibilities":
+            data = cols["DATA"]
+            if output is None:
+                axes = ["channel", "row", "correlation", "real_imag"]
+                shape = (chan_freq.size, nrows, data.shape[0], 2)
+                output = open_chunked_writer(
+                    filename=filename,
+                    shape=shape,
+                    dtype=data.real.dtype
+                )
+            rows = slice(startrow, startrow + data.shape[-1])
+            output[:, rows, :, 0] = np.transpose(data.real, axes=(1, 2, 0))
+            output[:, rows, :, 1] = np.transpose(data.imag, axes=(1, 2, 0))
+        else:
+            uvw = cols["UVW"]
+            if output is None:
+                axes = ["channel", "row", "uv"]
+                shape = (chan_freq.size, nrows, 2)
+                output = open_chunked_writer(
+                    filename=filename,
+                    shape=shape,
+                    dtype=np.float64
+                )
+            rows = slice(startrow, startrow + uvw.shape[-1])
+            output[:, rows, :] = np.moveaxis(
+                convert_array_to_wavelengths(
+                    array=uvw[:2, np.newaxis, :],
+                    frequency=chan_freq[np.newaxis, :, np.newaxis]
+                ),
+                0,
+                -1
+            )
+    close_chunked_writer(filename=filename, array=output)
+    print(
+        "shape ({}):".format(product), output.shape
+    )
+
+    write_metadata(
+        filename=filename,
+        metadata=get_layout_metadata(layout="channel", axes=axes, shape=shape)
+    )
+
+def get_sigma(ms, timebin=60.0, exclude_channels=None, nrow_chunk=100000):
+    # NOTE: As CASA's statwt, the scatter of the visibilities is computed per
+    # correlation within each (scan, baseline, time bin), over its unflagged rows
+    # and channels. exclude_channels are inclusive (start, stop) ranges, e.g. the
+    # channels of an emission line, that do not enter the scatter.
+    antenna1, antenna2 = get_antennas(ms=ms)
+    time = get_time(ms=ms)
+    scans = get_scans(ms=ms)
+    _, groups = np.unique(
+        np.stack(
+            arrays=(
+                scans,
+                antenna1,
+                antenna2,
+                np.floor((time - np.min(time)) / timebin).astype(np.int64),
+            )
+        ),
+        axis=1,
+        return_inverse=True
+    )
+    groups = groups.ravel()
+    num_groups = int(np.max(groups)) + 1
+    num_chan = np.atleast_1d(
+        get_num_chan(ms=ms)
+    )[0]
+    channels = np.ones(num_chan, dtype=bool)
+    if exclude_channels is not None:
+        for start, stop in exclude_channels:
+            channels[start:stop + 1] = False
+
+    sums = None
+    for startrow, cols in iter_col_chunks(
+        ms=ms,
+        table="",
+        colnames=["DATA", "FLAG"],
+        nrow_chunk=nrow_chunk
+    ):
+        data = cols["DATA"]
+        num_corr = data.shape[0]
+        if sums is None:
+            sums = np.zeros(
+                shape=(5, num_corr * num_groups)
+            )
+        valid = ~cols["FLAG"] & channels[np.newaxis, :, np.newaxis]
+
+        # NOTE: In float64 (DATA is often complex64), as the variance is taken
+        # from the difference of sums of squares.
+        real = np.where(valid, data.real.astype(np.float64), 0.0)
+        imag = np.where(valid, data.imag.astype(np.float64), 0.0)
+        index = (
+            np.arange(num_corr)[:, np.newaxis] * num_groups + groups[np.newaxis, startrow:startrow + data.shape[-1]]
+        ).ravel()
+        for i, values in enumerate([
+            valid,
+            real,
+            imag,
+            real ** 2.0,
+            imag ** 2.0,
+        ]):
+            sums[i] += np.bincount(
+                index,
+                weights=np.sum(values, axis=1).ravel(),
+                minlength=num_corr * num_groups
+            )
+    n, sum_real, sum_imag, sum_real_squared, sum_imag_squared = sums.reshape(5, -1, num_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance_real = (sum_real_squared - sum_real ** 2.0 / n) / (n - 1.0)
+        variance_imag = (sum_imag_squared - sum_imag ** 2.0 / n) / (n - 1.0)
+        sigma = np.sqrt(
+            (variance_real + variance_imag) / 2.0
+        )
+
+    # NOTE: Bins with fewer than two samples have no scatter; they get zero weight.
+    sigma[n < 2] = np.inf
+    print(
+        "{} of {} bins without an estimate of sigma".format(
+            np.count_nonzero(n < 2), n.size
+        )
+    )
+
+    return sigma[:, groups]
+
+def export_sigma(ms, filename, layout="native", timebin=60.0, exclude_channels=None, nrow_chunk=100000):
+    if product_exists(filename=filename):
+        print(
+            "{} already exists".format(filename)
+        )
+    else:
+        sigma = get_sigma(
+            ms=ms,
+            timebin=timebin,
+            exclude_channels=exclude_channels,
+            nrow_chunk=nrow_chunk
+        )
+        num_chan = np.atleast_1d(
+            get_num_chan(ms=ms)
+        )[0]
+
+        # NOTE: Same shape (and layout) as the visibilities, i.e. the same sigma
+        # for every channel and for the real and imaginary parts.
+        if layout == "channel":
+            axes = ["channel", "row", "correlation", "real_imag"]
+            shape = (num_chan, sigma.shape[1], sigma.shape[0], 2)
+        else:
+            axes = ["correlation", "channel", "row", "real_imag"]
+            shape = (sigma.shape[0], num_chan, sigma.shape[1], 2)
+        output = open_chunked_writer(
+            filename=filename,
+            shape=shape,
+            dtype=np.float64
+        )
+        for startrow in range(0, sigma.shape[1], nrow_chunk):
+            rows = slice(startrow, startrow + nrow_chunk)
+            if layout == "channel":
+                output[:, rows, :, :] = sigma[:, rows].T[np.newaxis, :, :, np.newaxis]
+            else:
+                output[:, :, rows, :] = sigma[:, np.newaxis, rows, np.newaxis]
+        close_chunked_writer(filename=filename, array=output)
+        print(
+            "shape (sigma):", output.shape
+        )
+        write_metadata(
+            filename=filename,
+            metadata=get_layout_metadata(layout=layout, axes=axes, shape=shape)
+        )
 
 def get_frequencies(ms):
     if os.path.isdir(ms):
@@ -258,15 +636,15 @@ def export_antennas(ms, filename):
         with open(filename, 'wb') as file:
             np.save(file, antennas)
 
-# def get_time(ms):
-#     time = getcol_wrapper(
-#         ms=ms,
-#         table="",
-#         colname="TIME"
-#     )
-#
-#     return np.asarray(time)
-#
+def get_time(ms):
+    time = getcol_wrapper(
+        ms=ms,
+        table="",
+        colname="TIME"
+    )
+
+    return np.asarray(time)
+
 # def export_time(ms, filename):
 #     time = get_time(
 #         ms=ms
@@ -311,16 +689,323 @@ def export_scans(ms, filename):
         with open(filename, 'wb') as file:
             np.save(file, scans)
 
+def export_shared_memory(ms, name):
+    if not shared_memory_is_imported:
+        raise ImportError(
+            "multiprocessing.shared_memory requires python >= 3.8"
+        )
+    getters = {
+        "visibilities": get_visibilities,
+        "uv_wavelengths": get_uv_wavelengths,
+        "antennas": get_antennas,
+        "scans": get_scans,
+    }
+    segments = []
+    descriptor = {}
+
+    # NOTE: The segments have to outlive this call for consumers to attach, so
+    # they are unlinked by release_shared_memory or, at the latest, on exit;
+    # registered up front so that segments created before a failure are too.
+    atexit.register(
+        release_shared_memory,
+        segments=segments,
+        descriptor=name + ".json"
+    )
+    try:
+        for product, getter in getters.items():
+            array = np.ascontiguousarray(
+                getter(ms=ms)
+            )
+            segment_name = "{}_{}".format(name, product)
+            try:
+                segment = shared_memory.SharedMemory(
+                    name=segment_name,
+                    create=True,
+                    size=max(array.nbytes, 1)
+                )
+            except FileExistsError: # NOTE: Left behind by a session that did not exit cleanly.
+                stale = shared_memory.SharedMemory(name=segment_name)
+                stale.close()
+                stale.unlink()
+                segment = shared_memory.SharedMemory(
+                    name=segment_name,
+                    create=True,
+                    size=max(array.nbytes, 1)
+                )
+            np.ndarray(
+                shape=array.shape,
+                dtype=array.dtype,
+                buffer=segment.buf
+            )[...] = array
+            segments.append(segment)
+            descriptor[product] = {
+                "name": segment.name,
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+            }
+            print(
+                "shape ({}):".format(product), array.shape
+            )
+            del array
+    except:
+        release_shared_memory(segments=segments)
+        raise
+    with open(name + ".json", 'w') as file:
+        json.dump(descriptor, file, indent=4)
+
+    return segments
+
+def release_shared_memory(segments, descriptor=None):
+    for segment in segments:
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+    if descriptor is not None and os.path.isfile(descriptor):
+        os.remove(descriptor)
+
+def attach_shared_memory(descriptor):
+    if not os.path.isfile(descriptor):
+        raise IOError(
+            "{} does not exist".format(descriptor)
+        )
+    with open(descriptor, 'r') as file:
+        products = json.load(file)
+    arrays = {}
+    segments = []
+    for product, description in products.items():
+        segment = shared_memory.SharedMemory(
+            name=description["name"]
+        )
+        # NOTE: Otherwise the resource tracker of the consumer unlinks the
+        # segment when the consumer exits, which is the exporter's job.
+        resource_tracker.unregister(
+            segment._name, "shared_memory"
+        )
+        arrays[product] = np.ndarray(
+            shape=tuple(description["shape"]),
+            dtype=np.dtype(description["dtype"]),
+            buffer=segment.buf
+        )
+        segments.append(segment)
+
+    # NOTE: The arrays are only valid for as long as the segments are open;
+    # call segment.close() on each once done (never unlink from a consumer).
+    return arrays, segments
+
+def get_line_channels(chan_freq, rest_frequency, redshift=0.0, velocity_range=(-500.0, 500.0), guard=0):
+    # NOTE: velocity_range (km/s, radio convention) is relative to the
+    # redshifted line; the channel range returned is inclusive and includes
+    # guard channels on either side.
+    frequency = rest_frequency / (1.0 + redshift)
+    frequencies = [
+        frequency * (1.0 - velocity * 1000.0 / 299792458.0)
+        for velocity in velocity_range
+    ]
+    channels = np.flatnonzero(
+        (chan_freq >= min(frequencies)) & (chan_freq <= max(frequencies))
+    )
+    if channels.size == 0:
+        # NOTE: A window narrower than a channel can fall between two channel
+        # centres; the channel nearest to the line is taken instead.
+        channel_width = np.max(np.abs(np.diff(chan_freq))) if chan_freq.size > 1 else np.inf
+        if np.min(chan_freq) - channel_width / 2.0 <= frequency <= np.max(chan_freq) + channel_width / 2.0:
+            channels = np.atleast_1d(
+                np.argmin(np.abs(chan_freq - frequency))
+            )
+    if channels.size == 0:
+        raise ValueError(
+            "The line ({:.6e} Hz) is outside of the spw ({:.6e} - {:.6e} Hz)".format(
+                frequency, np.min(chan_freq), np.max(chan_freq)
+            )
+        )
+
+    return (
+        int(max(channels[0] - guard, 0)),
+        int(min(channels[-1] + guard, chan_freq.size - 1))
+    )
+
+def get_phase_center(ms):
+    phase_dir = getcol_wrapper(
+        ms=ms,
+        table="FIELD",
+        colname="PHASE_DIR"
+    )
+
+    # NOTE: (ra, dec) in radians of the (first) field.
+    return np.reshape(phase_dir, (2, -1))[:, 0]
+
+def get_phase_shift_lmn(phase_center_ms, phase_center):
+    ra_0, dec_0 = phase_center_ms
+    ra, dec = phase_center
+    l = np.cos(dec) * np.sin(ra - ra_0)
+    m = np.sin(dec) * np.cos(dec_0) - np.cos(dec) * np.sin(dec_0) * np.cos(ra - ra_0)
+
+    return l, m, np.sqrt(1.0 - l ** 2.0 - m ** 2.0)
+
+def export_phase_shifted(ms, filename, phase_center, layout="native", nrow_chunk=100000):
+    # NOTE: phase_center is the new (ra, dec) in degrees. The visibilities are
+    # rotated by exp(2 pi i (u l + v m + w (n - 1))), with (l, m, n) the new
+    # centre relative to the phase centre of the ms, one chunk of rows at a
+    # time; uvw are not reprojected, which holds for small offsets (e.g. of the
+    # lens centroid from the pointing).
+    phase_center_ms = get_phase_center(ms=ms)
+    l, m, n = get_phase_shift_lmn(
+        phase_center_ms=phase_center_ms,
+        phase_center=np.radians(phase_center)
+    )
+    chan_freq = np.atleast_1d(
+        getcol_wrapper(
+            ms=ms,
+            table="SPECTRAL_WINDOW",
+            colname="CHAN_FREQ"
+        )
+    )
+    # NOTE: Before the loop, as iter_col_chunks holds tb open while it runs.
+    nrows = get_nrows(ms=ms)
+    visibilities = None
+    for startrow, cols in iter_col_chunks(
+        ms=ms,
+        table="",
+        colnames=["DATA", "UVW"],
+        nrow_chunk=nrow_chunk
+    ):
+        data = cols["DATA"]
+        uvw = cols["UVW"]
+        if visibilities is None:
+            if layout == "channel":
+                axes = ["channel", "row", "correlation", "real_imag"]
+                shape = (chan_freq.size, nrows, data.shape[0], 2)
+            else:
+                axes = ["correlation", "channel", "row", "real_imag"]
+                shape = (data.shape[0], chan_freq.size, nrows, 2)
+            visibilities = open_chunked_writer(
+                filename=filename,
+                shape=shape,
+                dtype=data.real.dtype
+            )
+        phase = 2.0 * np.pi * convert_array_to_wavelengths(
+            array=(uvw[0] * l + uvw[1] * m + uvw[2] * (n - 1.0))[np.newaxis, :],
+            frequency=chan_freq[:, np.newaxis]
+        )
+        data = data * np.exp(1j * phase)[np.newaxis, :, :]
+        rows = slice(startrow, startrow + data.shape[-1])
+        if layout == "channel":
+            visibilities[:, rows, :, 0] = np.transpose(data.real, axes=(1, 2, 0))
+            visibilities[:, rows, :, 1] = np.transpose(data.imag, axes=(1, 2, 0))
+        else:
+            visibilities[:, :, rows, 0] = data.real
+            visibilities[:, :, rows, 1] = data.imag
+    close_chunked_writer(filename=filename, array=visibilities)
+    print(
+        "shape (visibilities):", visibilities.shape
+    )
+    write_metadata(
+        filename=filename,
+        metadata=dict(
+            get_layout_metadata(layout=layout, axes=axes, shape=shape),
+            **{
+                "phase_center": list(phase_center),
+                "phase_center_ms": list(np.degrees(phase_center_ms)),
+                "lmn": [l, m, n],
+            }
+        )
+    )
+
 if __name__ == "__main__": # NOTE: spw == "31" has an emission line
     uid = "A002_X11adad7_Xdfdb"
     field = "SPT0314-44"
     if True:
         #width = 15
         width = 30
+
+        # NOTE: Also estimate sigma (as statwt) from the scatter of the visibilities,
+        # at the cost of another pass over DATA.
+        estimate_sigma = False
+
+        # NOTE: Inclusive (start, stop) channel ranges (e.g. of the line) left out of the estimate of sigma.
+        exclude_channels = None
+
+        # NOTE: "channel" stores visibilities and uv_wavelengths channel-major (see the .json next to them).
+        layout = "native"
+
+        # NOTE: Only export the channels within velocity_range (km/s) of the line at
+        # rest_frequency (Hz) and redshift, plus guard channels on either side.
+        rest_frequency = None
+        redshift = 0.0
+        velocity_range = (-500.0, 500.0)
+        guard = 0
+
+        # NOTE: Rotate the visibilities to this (ra, dec) in degrees, e.g. the lens centroid.
+        phase_center = None
+
+        # NOTE: Publish the products to shared memory (see attach_shared_memory) instead of to disk.
+        use_shared_memory = False
+
+        # NOTE: Processes reading the sub-MSs of a multi-MS; None for one per CPU available.
+        num_workers = None
+        get_executor(num_workers=num_workers)
+
+        # NOTE: Only export_visibilities applies phase_center.
+        if phase_center is not None and use_shared_memory:
+            raise NotImplementedError(
+                "phase_center can not be combined with use_shared_memory"
+            )
         outputvis = "uid___{}_width_{}.ms.split.cal.contsub".format(
             uid,
             width
         )
+        spw = "0"
+        suffix = ""
+
+        # ========== #
+        # NOTE: Only the channels of the line are split (and so read and written).
+        # ========== #
+        if rest_frequency is not None:
+            start, stop = get_line_channels(
+                chan_freq=np.atleast_1d(
+                    get_frequencies(
+                        ms="uid___{}.ms.split.cal.contsub".format(
+                            uid,
+                        )
+                    )
+                ),
+                rest_frequency=rest_frequency,
+                redshift=redshift,
+                velocity_range=velocity_range,
+                guard=guard
+            )
+            print(
+                "line window: channels {} - {}".format(start, stop)
+            )
+            outputvis = "uid___{}_width_{}_channels_{}_{}.ms.split.cal.contsub".format(
+                uid,
+                width,
+                start,
+                stop
+            )
+            spw = "0:{}~{}".format(start, stop)
+            suffix = "_channels_{}_{}".format(start, stop)
+            write_metadata(
+                filename="line_window_{}_{}_spw_31_width_{}_contsub{}".format(
+                    uid,
+                    field,
+                    width,
+                    suffix
+                ),
+                metadata={
+                    "rest_frequency": rest_frequency,
+                    "redshift": redshift,
+                    "velocity_range": list(velocity_range),
+                    "guard": guard,
+                    "channels": [start, stop],
+                }
+            )
+        # ========== #
+        # END
+        # ========== #
+
         if not os.path.isdir(outputvis):
             split(
                 vis="uid___{}.ms.split.cal.contsub".format(
@@ -329,103 +1014,146 @@ if __name__ == "__main__": # NOTE: spw == "31" has an emission line
                 outputvis=outputvis,
                 keepmms=True,
                 field=field,
-                spw="0",
+                spw=spw,
                 datacolumn="data",
                 width=width,
                 keepflags=False
             )
 
         # ========== #
-        # NOTE: ...
+        # NOTE: Publish the products to shared memory instead of writing them to disk.
         # ========== #
-        filename_uv_wavelengths = "uv_wavelengths_{}_{}_spw_31_width_{}_contsub".format(
-            uid,
-            field,
-            width,
-        )
-        if os.path.isfile(filename_uv_wavelengths + ".fits") or os.path.isfile(filename_uv_wavelengths + ".numpy"):
-            pass
-        else:
-            export_uv_wavelengths(
+        if use_shared_memory:
+            export_shared_memory(
                 ms=outputvis,
-                filename=filename_uv_wavelengths
+                name="{}_{}_spw_31_width_{}_contsub{}".format(
+                    uid,
+                    field,
+                    width,
+                    suffix
+                )
             )
-        # ========== #
-        # END
-        # ========== #
-
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename_visibilities = "visibilities_{}_{}_spw_31_width_{}_contsub".format(
-            uid,
-            field,
-            width,
-        )
-        if os.path.isfile(filename_visibilities + ".fits") or os.path.isfile(filename_visibilities + ".numpy"):
-            pass
         else:
-            export_visibilities(
-                ms=outputvis,
-                filename=filename_visibilities
+            # ========== #
+            # NOTE: ...
+            # ========== #
+            filename_uv_wavelengths = "uv_wavelengths_{}_{}_spw_31_width_{}_contsub{}".format(
+                uid,
+                field,
+                width,
+                suffix
             )
-        # ========== #
-        # END
-        # ========== #
+            if os.path.isfile(filename_uv_wavelengths + ".fits") or os.path.isfile(filename_uv_wavelengths + ".numpy"):
+                pass
+            else:
+                export_uv_wavelengths(
+                    ms=outputvis,
+                    filename=filename_uv_wavelengths,
+                    layout=layout
+                )
+            # ========== #
+            # END
+            # ========== #
 
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename = "antennas_{}_{}_spw_31_width_{}_contsub".format(
-            uid,
-            field,
-            width
-        )
-        if os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy"):
-            pass
-        else:
-            export_antennas(
-                ms=outputvis,
-                filename=filename
+            # ========== #
+            # NOTE: ...
+            # ========== #
+            filename_visibilities = "visibilities_{}_{}_spw_31_width_{}_contsub{}".format(
+                uid,
+                field,
+                width,
+                suffix
             )
-        # ========== #
-        # END
-        # ========== #
+            if phase_center is not None:
+                filename_visibilities += "_phase_center_{}_{}".format(*phase_center)
+            if os.path.isfile(filename_visibilities + ".fits") or os.path.isfile(filename_visibilities + ".numpy"):
+                pass
+            else:
+                export_visibilities(
+                    ms=outputvis,
+                    filename=filename_visibilities,
+                    layout=layout,
+                    phase_center=phase_center
+                )
+            # ========== #
+            # END
+            # ========== #
 
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename = "scans_{}_{}_spw_31_width_{}_contsub".format(
-            uid,
-            field,
-            width
-        )
-        if os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy"):
-            pass
-        else:
-            export_scans(
-                ms=outputvis,
-                filename=filename
+            # ========== #
+            # NOTE: ...
+            # ========== #
+            filename = "antennas_{}_{}_spw_31_width_{}_contsub{}".format(
+                uid,
+                field,
+                width,
+                suffix
             )
-        # ========== #
-        # END
-        # ========== #
+            if os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy"):
+                pass
+            else:
+                export_antennas(
+                    ms=outputvis,
+                    filename=filename
+                )
+            # ========== #
+            # END
+            # ========== #
 
-        # ========== #
-        # NOTE: ...
-        # ========== #
-        filename = "frequencies_{}_{}_spw_31_width_{}_contsub".format(
-            uid,
-            field,
-            width
-        )
-        if os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy"):
-            pass
-        else:
-            export_frequencies(
-                ms=outputvis,
-                filename=filename
+            # ========== #
+            # NOTE: ...
+            # ========== #
+            filename = "scans_{}_{}_spw_31_width_{}_contsub{}".format(
+                uid,
+                field,
+                width,
+                suffix
             )
-        # ========== #
-        # END
-        # ========== #
+            if os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy"):
+                pass
+            else:
+                export_scans(
+                    ms=outputvis,
+                    filename=filename
+                )
+            # ========== #
+            # END
+            # ========== #
+
+            # ========== #
+            # NOTE: ...
+            # ========== #
+            filename = "frequencies_{}_{}_spw_31_width_{}_contsub{}".format(
+                uid,
+                field,
+                width,
+                suffix
+            )
+            if os.path.isfile(filename + ".fits") or os.path.isfile(filename + ".numpy"):
+                pass
+            else:
+                export_frequencies(
+                    ms=outputvis,
+                    filename=filename
+                )
+            # ========== #
+            # END
+            # ========== #
+
+            # ========== #
+            # NOTE: Empirical sigma (as statwt) estimated from the visibilities.
+            # ========== #
+            if estimate_sigma:
+                export_sigma(
+                    ms=outputvis,
+                    filename="sigma_{}_{}_spw_31_width_{}_contsub{}".format(
+                        uid,
+                        field,
+                        width,
+                        suffix
+                    ),
+                    layout=layout,
+                    exclude_channels=exclude_channels
+                )
+            # ========== #
+            # END
+            # ========== #